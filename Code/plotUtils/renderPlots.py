@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+import os
+import re
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ROOT
+
+from plotUtils.utility import *
+
+#########################################################################
+
+# Plots are made in a separate stage, once all histograms (with the IOV projections and the threshold views) are saved
+# in the output file. Each plot is a render job, a plain dictionary referring to the histograms by their path in the file
+#   kind        : "TH1" for 1D histograms, "vsRun" for TH2 versus run (with the plot of the projections for each IOV)
+#   name        : path of the histogram in the file
+#   projections : paths of the IOV projections (only for vsRun, possibly empty)
+#   options     : plotting options from the spec (e.g. logz, logy, skipStatBox)
+#   outdir      : where the plots are saved
+# so that the jobs can be distributed to a pool of processes, each one reading the histograms from the file
+# and drawing them on its own canvases
+
+_canvases = {}
+_openFiles = {}
+
+#########################################################################
+
+def getCanvases():
+    # canvases of this process, created at first use
+    if not _canvases:
+        _canvases["canvas"]        = ROOT.TCanvas("canvas","", 800,800)
+        _canvases["canvas1D"]      = ROOT.TCanvas("canvas1D","", 900,800)
+        _canvases["canvas1Dshort"] = ROOT.TCanvas("canvas1Dshort","", 800,700)
+    return _canvases
+
+#########################################################################
+
+def initRenderWorker(rootlogon=None, skipUnchanged=True, formats=None):
+    # same style settings as in the main process
+    ROOT.gROOT.SetBatch(True)
+    setSkipUnchangedPlots(skipUnchanged)
+    if formats is not None:
+        setPlotFormats(formats)
+    if rootlogon and os.path.isfile(rootlogon):
+        ROOT.gROOT.ProcessLine(f".L {rootlogon}")
+    getCanvases()
+    adjustSettings_CMS_lumi()
+
+#########################################################################
+
+def getIOVProjections(h, runBins):
+    # projections on the y axis of a TH2 versus run, for each IOV (given as the bins of the run axis)
+    return [h.ProjectionY(f"{h.GetName()}_projY_IOV{i+1}",runBins[i],runBins[i],"e") for i in range(len(runBins))]
+
+#########################################################################
+
+def drawHistogram1D(h, opts, outdir):
+    drawTH1(h, h.GetTitle(),
+            "Events", outdir, h.GetName(),
+            passCanvas=getCanvases()["canvas1Dshort"],
+            skipStatBox=True if "skipStatBox" in opts else False,
+            setLogy=True if "logy" in opts else False
+    )
+
+#########################################################################
+
+def drawHistogramVsRun(h, projections, opts, outdir):
+
+    # plot a TH2 with run on the x axis, and the projections on the y axis for each IOV (one plot with all of them)
+
+    canvases = getCanvases()
+    drawCorrelationPlot(h,
+                        h.GetXaxis().GetTitle(), h.GetYaxis().GetTitle(), h.GetZaxis().GetTitle(),
+                        h.GetName(), outdir=outdir, drawProfileX=True,
+                        draw_both0_noLog1_onlyLog2=2 if "logz" in opts else 1,
+                        passCanvas=canvases["canvas"], palette=57, skipLumi=True)
+    if not projections:
+        return
+    legEntries = [f"IOV {i+1}" for i in range(len(projections))]
+    if len(projections) == 1:
+        drawTH1(projections[0], h.GetYaxis().GetTitle(),
+                "Events", outdir, projections[0].GetName(),
+                passCanvas=canvases["canvas1Dshort"],
+                skipStatBox=True if "skipStatBox" in opts else False,
+                setLogy=True if "logy" in opts else False
+        )
+    else:
+        drawNTH1(projections, legEntries, h.GetYaxis().GetTitle(), h.GetZaxis().GetTitle(),
+                 f"{h.GetName()}_projY", outdir=outdir, draw_both0_noLog1_onlyLog2=2 if "logz" in opts else 1,
+                 labelRatioTmp="IOV_{N} / IOV_{1}::0.5,1.5",
+                 legendCoords="0.75,0.95,0.4,0.9", lowerPanelHeight=0.3, passCanvas=canvases["canvas1D"],
+                 skipLumi=True, drawLineMarkerAsPalette=True, palette=105)
+
+#########################################################################
+
+def getHistogramFromFile(fname, name):
+    # files stay open in each process until closeRenderFiles is called, since each worker renders many jobs
+    if fname not in _openFiles:
+        _openFiles[fname] = ROOT.TFile.Open(fname)
+    h = _openFiles[fname].Get(name)
+    if not h:
+        raise RuntimeError(f"Error in getHistogramFromFile(): cannot find {name} in {fname}")
+    return h
+
+#########################################################################
+
+def closeRenderFiles():
+    for tfile in _openFiles.values():
+        tfile.Close()
+    _openFiles.clear()
+
+#########################################################################
+
+def renderJob(fname, job):
+    h = getHistogramFromFile(fname, job["name"])
+    if job["kind"] == "TH1":
+        drawHistogram1D(h, job["options"], job["outdir"])
+    else:
+        projections = [getHistogramFromFile(fname, p) for p in job["projections"]]
+        drawHistogramVsRun(h, projections, job["options"], job["outdir"])
+    return job["name"]
+
+#########################################################################
+
+def getRenderJobsFromFile(fname, plotOptions, outdir, directory=""):
+
+    # render jobs for the histograms saved in a file by a previous job, in the order in which they were written
+    # plotOptions is {name : options}, from the histogram specs (histograms without spec are plotted without options)
+    # the IOV projections are attached to their histogram, and the views of a threshold scan take the options of its TH3
+    # returns an empty list if directory is not in the file
+
+    jobs = []
+    tfile = ROOT.TFile.Open(fname)
+    if not tfile or tfile.IsZombie():
+        raise RuntimeError(f"Error in getRenderJobsFromFile(): cannot open {fname}")
+    tdir = tfile.Get(directory.rstrip("/")) if directory else tfile
+    if not tdir:
+        tfile.Close()
+        return jobs
+    keys = []
+    for key in tdir.GetListOfKeys():
+        # only the last cycle of each object
+        if key.GetName() not in [name for name,_ in keys]:
+            keys.append((key.GetName(), key.GetClassName()))
+    names = set(name for name,_ in keys)
+    scanOptions = []
+    for name,className in keys:
+        cls = ROOT.TClass.GetClass(className)
+        if not cls or not cls.InheritsFrom("TH1") or re.search("_projY_IOV[0-9]+$", name):
+            continue
+        if cls.InheritsFrom("TH3"):
+            scanOptions = plotOptions.get(name, [])
+            continue
+        opts = plotOptions.get(name, scanOptions)
+        if cls.InheritsFrom("TH2"):
+            projections = []
+            while f"{name}_projY_IOV{len(projections)+1}" in names:
+                projections.append(f"{directory}{name}_projY_IOV{len(projections)+1}")
+            jobs.append({"kind" : "vsRun", "name" : directory + name, "projections" : projections, "options" : opts, "outdir" : outdir})
+        else:
+            jobs.append({"kind" : "TH1", "name" : directory + name, "projections" : [], "options" : opts, "outdir" : outdir})
+    tfile.Close()
+    return jobs
+
+#########################################################################
+
+def renderPlots(fname, jobs, nJobs=1, rootlogon=None, skipUnchanged=True, formats=None):
+
+    # make all plots of jobs reading the histograms from fname, in this process or with a pool of nJobs processes
+    # (spawned, as for the event loop, and in batch mode)
+    # a plot that fails is reported but does not stop the others
+    # plots whose histograms and options did not change are not saved again, unless skipUnchanged is False
+    # formats (e.g. ["png"]) replaces the output formats of the plots, if not None (an empty list saves nothing)
+
+    logging.info(f"Making {len(jobs)} plots" + (f" with {nJobs} parallel jobs" if nJobs > 1 else ""))
+    if nJobs <= 1:
+        setSkipUnchangedPlots(skipUnchanged)
+        previousFormats = getPlotFormats()
+        if formats is not None:
+            setPlotFormats(formats)
+        for job in jobs:
+            try:
+                renderJob(fname, job)
+            except Exception as e:
+                logging.error(f"Plot of {job['name']} failed ({e})")
+        closeRenderFiles()
+        setPlotFormats(previousFormats)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=nJobs, mp_context=context, initializer=initRenderWorker, initargs=(rootlogon, skipUnchanged, formats)) as pool:
+        futures = {pool.submit(renderJob, fname, job) : job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                logging.debug(f"Plot of {future.result()} done")
+            except Exception as e:
+                logging.error(f"Plot of {futures[future]['name']} failed ({e})")
+
+#########################################################################
+
+# Deferred export: the plots can be saved in the quick formats only (e.g. png), while their render jobs are kept in a
+# queue file, to be made later in the slow ones (e.g. pdf) from the same histograms saved in the output file
+# The queue is {"file" : output file with the histograms, "formats" : formats to be made, "jobs" : render jobs}
+
+def queueDeferredExport(queueName, fname, jobs, formats):
+    # add jobs to the queue (replacing those for the same histogram, so the queue does not grow with repeated runs)
+    queue = {"file" : fname, "formats" : list(formats), "jobs" : []}
+    if os.path.isfile(queueName):
+        with open(queueName) as f:
+            queue = json.load(f)
+        queue["file"] = fname
+        queue["formats"] = sorted(set(queue["formats"]) | set(formats))
+    names = set(job["name"] for job in jobs)
+    queue["jobs"] = [job for job in queue["jobs"] if job["name"] not in names] + list(jobs)
+    with open(queueName + ".tmp", "w") as f:
+        json.dump(queue, f, indent=1)
+    os.replace(queueName + ".tmp", queueName)
+    logging.info(f"{len(queue['jobs'])} plots queued in {queueName} for the export in {','.join(queue['formats'])}")
+
+#########################################################################
+
+def runDeferredExport(queueName, nJobs=1, rootlogon=None, skipUnchanged=True):
+    # make the queued plots in the deferred formats, then remove the queue
+    if not os.path.isfile(queueName):
+        logging.warning(f"No deferred export queue {queueName}, nothing to do")
+        return
+    with open(queueName) as f:
+        queue = json.load(f)
+    renderPlots(queue["file"], queue["jobs"], nJobs=nJobs, rootlogon=rootlogon, skipUnchanged=skipUnchanged, formats=queue["formats"])
+    os.remove(queueName)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import re, sys, os, os.path, subprocess, json, ROOT, copy, math
+import re, sys, os, os.path, subprocess, json, ROOT, copy, math, hashlib
 import numpy as np
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -54,9 +54,8 @@ def getMinMaxHisto(h, excludeEmpty=True, sumError=True,
                    excludeUnderflow=True, excludeOverflow=True,
                    excludeMin=None, excludeMax=None):
     
-    # Warning, fix this function, GetBinContent with TH2 is not that simple, there are the underflow and overflow in each row and column
-    # must check whether bin is underflow or overflow
-    # therefore, the global bin is obtained as the number of bins +2, multiplied for each axis
+    # The global bin is obtained as the number of bins +2, multiplied for each axis, so each row and column has its
+    # own underflow and overflow bins: a bin is underflow (overflow) if it is underflow (overflow) on any axis
 
     # excludeEmpty = True exclude bins with content 0.0. Useful when a histogram is filled with values in, for example, [1,2] but hassome empty bins
     # excludeMin/Max are used to select a range in which to look for maximum and minimum, useful to reject outliers, crazy or empty bins and so on
@@ -72,126 +71,76 @@ def getMinMaxHisto(h, excludeEmpty=True, sumError=True,
     # for example, one can pass excludeMin=h.GetMean()-2*h.GetStdDev() and excludeMax=h.GetMean()+2*h.GetStdDev() so to 
     # select a range of 2 sigma around the mean
 
+    # all bins are selected at once with numpy masks on the arrays of the histogram
+    # if no bin is selected, min,max = sys.float_info.max,-sys.float_info.max are returned
+
     dim = h.GetDimension()
-    nbins = 0
-    if   dim == 1: nbins = h.GetNbinsX() + 2
-    elif dim == 2: nbins = (h.GetNbinsX() + 2) * (h.GetNbinsY() + 2)
-    elif dim == 3: nbins = (h.GetNbinsX() + 2) * (h.GetNbinsY() + 2) * (h.GetNbinsZ() + 2)
-    else:
+    if dim not in [1, 2, 3]:
         logging.error("In getMaxHisto(): dim = %d is not supported. Exit" % dim)
         quit()
 
-    maxval = -sys.float_info.max
-    minval = sys.float_info.max
-    firstValidBin = -1
-    for ibin in range (1,nbins+1):
-        if excludeUnderflow and h.IsBinUnderflow(ibin): continue
-        if excludeOverflow and h.IsBinOverflow(ibin): continue
-        tmpmax = h.GetBinContent(ibin)
-        tmpmin = h.GetBinContent(ibin)
-        if excludeEmpty and tmpmin == 0.0: continue
-        if excludeMin != None and tmpmin <= excludeMin: continue
-        if excludeMax != None and tmpmax >= excludeMax: continue
-        if firstValidBin < 0: 
-            logging.debug("ibin %d:   tmpmin,tmpmax = %.2f, %.2f" % (ibin,tmpmin,tmpmax))
-            firstValidBin = ibin
-        if sumError:
-            tmpmin -= h.GetBinError(ibin)
-            tmpmax += h.GetBinError(ibin)
-        if firstValidBin > 0 and ibin == firstValidBin:
-            #the first time we pick a non empty bin, we set min and max to the histogram content in that bin
-            minval = tmpmin
-            maxval = tmpmax
-            logging.debug("#### ibin %d:   min,max = %.2f, %.2f" % (ibin,minval,maxval))
-        else:
-            minval = min(minval,tmpmin)
-            maxval = max(maxval,tmpmax)
-        logging.debug("ibin %d:   min,max = %.2f, %.2f" % (ibin,minval,maxval))
-    
+    content,error = getBinContentsAndErrors(h, withErrors=sumError)
+    binx,biny,binz = getBinIndices(h)
+    underflow = binx == 0
+    overflow = binx == h.GetNbinsX() + 1
+    if dim > 1:
+        underflow |= biny == 0
+        overflow |= biny == h.GetNbinsY() + 1
+    if dim > 2:
+        underflow |= binz == 0
+        overflow |= binz == h.GetNbinsZ() + 1
+
+    # global bin 0 was never considered (the loop used to start from 1), keep it this way
+    mask = np.arange(content.size) > 0
+    if excludeUnderflow: mask &= ~underflow
+    if excludeOverflow:  mask &= ~overflow
+    if excludeEmpty:     mask &= content != 0.0
+    if excludeMin != None: mask &= content > excludeMin
+    if excludeMax != None: mask &= content < excludeMax
+    if not mask.any():
+        return sys.float_info.max,-sys.float_info.max
+
+    minval = content[mask]
+    maxval = content[mask]
+    if sumError:
+        minval = minval - error[mask]
+        maxval = maxval + error[mask]
+    minval,maxval = float(minval.min()),float(maxval.max())
+    logging.debug("min,max = %.2f, %.2f" % (minval,maxval))
     return minval,maxval
 
 #########################################################################
 
 def getMinimumTH(h, excludeMin=None):
     # get minimum excluding some values. For example, if an histogram has an empty bin, one might want to get the minimum such that it is > 0
-    # underflow are not considered
+    # underflow are not considered (nor overflow)
     
     dim = h.GetDimension()
-    retmin = sys.float_info.max
-
-    if dim == 1:
-        for ix in range(1,h.GetNbinsX()+1):
-            if retmin > h.GetBinContent(ix):
-                if excludeMin != None:
-                    if h.GetBinContent(ix) > excludeMin: retmin = h.GetBinContent(ix)
-                else:
-                    retmin = h.GetBinContent(ix)
-
-    elif dim == 2:
-        for ix in range(1,h.GetNbinsX()+1):
-            for iy in range(1,h.GetNbinsY()+1):
-                if retmin > h.GetBinContent(ix,iy):
-                    if excludeMin != None:
-                        if h.GetBinContent(ix,iy) > excludeMin: retmin = h.GetBinContent(ix,iy)
-                    else:
-                        retmin = h.GetBinContent(ix,iy)
-
-    elif dim == 3:
-        for ix in range(1,h.GetNbinsX()+1):
-            for iy in range(1,h.GetNbinsY()+1):
-                for iz in range(1,h.GetNbinsZ()+1):
-                    if retmin > h.GetBinContent(ix,iy,iz):
-                        if excludeMin != None:
-                            if h.GetBinContent(ix,iy,iz) > excludeMin: retmin = h.GetBinContent(ix,iy,iz)
-                        else:
-                            retmin = h.GetBinContent(ix,iy,iz)
-                            
-
-    else:
+    if dim not in [1, 2, 3]:
         raise RuntimeError("Error in getMinimumTH(): unsupported histogram's dimension (%d)" % dim)
 
-    return retmin
+    content,_ = getBinContentsAndErrors(h, withErrors=False)
+    values = getInnerBins(h, content)
+    if excludeMin != None:
+        values = values[values > excludeMin]
+    return float(np.min(values, initial=sys.float_info.max))
 
 #########################################################################
 
 def getMaximumTH(h, excludeMax=None):
     # get maximum excluding some values. For example, if an histogram has a crazy bin, one might want to get the maximum value that is lower than that
-    # overflow are not considered
+    # overflow are not considered (nor underflow)
+    # as for the original loop, the result is never below sys.float_info.min (the smallest positive float)
     
     dim = h.GetDimension()
-    retmax = sys.float_info.min
-
-    if dim == 1:
-        for ix in range(1,h.GetNbinsX()+1):
-            if retmax < h.GetBinContent(ix):
-                if excludeMax != None:
-                    if h.GetBinContent(ix) < excludeMax: retmax = h.GetBinContent(ix)
-                else:
-                    retmax = h.GetBinContent(ix)
-
-    elif dim == 2:
-        for ix in range(1,h.GetNbinsX()+1):
-            for iy in range(1,h.GetNbinsY()+1):
-                if retmax < h.GetBinContent(ix,iy):
-                    if excludeMax != None:
-                        if h.GetBinContent(ix,iy) < excludeMax: retmax = h.GetBinContent(ix,iy)                        
-                    else:
-                        retmax = h.GetBinContent(ix,iy)
-
-    elif dim == 3:
-        for ix in range(1,h.GetNbinsX()+1):
-            for iy in range(1,h.GetNbinsY()+1):
-                for iz in range(1,h.GetNbinsZ()+1):
-                    if retmax < h.GetBinContent(ix,iy,iz):
-                        if excludeMax != None:
-                            if h.GetBinContent(ix,iy,iz) < excludeMax: retmax = h.GetBinContent(ix,iy,iz)
-                        else:
-                            retmax = h.GetBinContent(ix,iy,iz)
-
-    else:
+    if dim not in [1, 2, 3]:
         raise RuntimeError("Error in getMaximumTH(): unsupported histogram's dimension (%d)" % dim)
 
-    return retmax
+    content,_ = getBinContentsAndErrors(h, withErrors=False)
+    values = getInnerBins(h, content)
+    if excludeMax != None:
+        values = values[values < excludeMax]
+    return float(np.max(values, initial=sys.float_info.min))
 
 
 #########################################################################
@@ -233,6 +182,144 @@ def createPlotDirAndCopyPhp(outdir):
 
 #########################################################################
 
+# Output formats of the plots, png and pdf by default. Saving large 2D plots as pdf is slow, so quick looks can use
+# only png, with the pdf made later from the histograms saved in the output file (see plotUtils/renderPlots.py)
+
+_plotFormats = ["png", "pdf"]
+
+def setPlotFormats(formats):
+    global _plotFormats
+    _plotFormats = list(formats)
+
+def getPlotFormats():
+    return list(_plotFormats)
+
+def saveCanvas(canvas, basename):
+    # save the canvas in all formats, basename is the path without extension
+    for ext in _plotFormats:
+        canvas.SaveAs(f"{basename}.{ext}")
+
+#########################################################################
+
+# Plots whose content did not change are not saved again: the draw functions compute a hash of the histograms
+# (contents, errors, binning, titles) and of their arguments, and skip the plot if all its outputs already exist
+# with the same hash, which is kept in a small json file for each plot in the .plotManifest directory next to them
+# (one hash for each output, since the formats can be made at different times, see setPlotFormats)
+# The code of this file also enters the hash, so that a change of style makes all plots again
+
+_skipUnchangedPlots = True
+_plotManifestDir = ".plotManifest"
+with open(__file__, "rb") as _f:
+    _plotCodeHash = hashlib.sha1(_f.read()).hexdigest()
+
+def setSkipUnchangedPlots(skip=True):
+    global _skipUnchangedPlots
+    _skipUnchangedPlots = skip
+
+#########################################################################
+
+def getHistogramArrays(h):
+    # numpy views (no copy) of the bin contents and of the sum of squared weights (None if not stored) of a histogram,
+    # indexed by global bin number, so including under/overflow bins
+    h.BufferEmpty()
+    n = h.GetNcells()
+    content = h.GetArray()
+    content.reshape((n,))
+    sumw2 = None
+    if h.GetSumw2N():
+        sumw2 = h.GetSumw2().GetArray()
+        sumw2.reshape((n,))
+        sumw2 = np.asarray(sumw2)
+    return np.asarray(content),sumw2
+
+#########################################################################
+
+def getBinContentsAndErrors(h, withErrors=True):
+    # bin contents and errors (None if not withErrors) as numpy arrays indexed by global bin number
+    # views of the histogram arrays are used when possible, profiles and other classes fall back to GetBinContent/GetBinError
+    n = h.GetNcells()
+    if (h.InheritsFrom("TProfile") or h.InheritsFrom("TProfile2D") or h.InheritsFrom("TProfile3D") or h.GetBinErrorOption() != ROOT.TH1.kNormal
+        or not isinstance(h, (ROOT.TArrayD, ROOT.TArrayF, ROOT.TArrayI))):
+        content = np.array([h.GetBinContent(i) for i in range(n)], dtype=np.float64)
+        error = np.array([h.GetBinError(i) for i in range(n)], dtype=np.float64) if withErrors else None
+        return content,error
+    content,sumw2 = getHistogramArrays(h)
+    content = content.astype(np.float64, copy=False)
+    error = None
+    if withErrors:
+        # as TH1::GetBinError, without sum of squared weights the error is sqrt(|content|)
+        error = np.sqrt(sumw2) if sumw2 is not None else np.sqrt(np.abs(content))
+    return content,error
+
+#########################################################################
+
+def getBinIndices(h):
+    # bin number on each axis (binx,biny,binz) of every global bin, as numpy arrays
+    g = np.arange(h.GetNcells())
+    nx = h.GetNbinsX() + 2
+    ny = h.GetNbinsY() + 2
+    return g % nx, (g // nx) % ny, g // (nx * ny)
+
+#########################################################################
+
+def getInnerBins(h, values):
+    # values of the bins which are neither underflow nor overflow on any axis, from an array indexed by global bin
+    dim = h.GetDimension()
+    shape = [h.GetNbinsZ() + 2, h.GetNbinsY() + 2, h.GetNbinsX() + 2][3-dim:]
+    return values.reshape(shape)[(slice(1,-1),) * dim]
+
+#########################################################################
+
+def getPlotHash(hists, styleArgs, canvas=None):
+    sha = hashlib.sha1(_plotCodeHash.encode())
+    for h in hists:
+        content,sumw2 = getHistogramArrays(h)
+        sha.update(content.tobytes())
+        if sumw2 is not None:
+            sha.update(sumw2.tobytes())
+        axes = [h.GetXaxis(), h.GetYaxis(), h.GetZaxis()]
+        binning = [(ax.GetNbins(), ax.GetXmin(), ax.GetXmax(), ax.GetFirst(), ax.GetLast(), ax.GetTitle(),
+                    [ax.GetXbins().At(i) for i in range(ax.GetXbins().GetSize())]) for ax in axes]
+        sha.update(repr((h.ClassName(), h.GetName(), h.GetTitle(), h.GetEntries(), binning)).encode())
+    if canvas != None:
+        sha.update(repr((canvas.GetWw(), canvas.GetWh())).encode())
+    sha.update(repr(sorted(styleArgs.items())).encode())
+    return sha.hexdigest()
+
+#########################################################################
+
+def getPlotManifestName(outputs):
+    # one manifest for each plot, named as the first output without extension
+    dirname,basename = os.path.split(outputs[0])
+    return os.path.join(dirname, _plotManifestDir, os.path.splitext(basename)[0] + ".json")
+
+def isPlotUpToDate(outputs, plotHash):
+    if not _skipUnchangedPlots:
+        return False
+    try:
+        with open(getPlotManifestName(outputs)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    hashes = manifest.get("outputs", {})
+    return all(hashes.get(os.path.basename(x)) == plotHash and os.path.isfile(x) for x in outputs)
+
+def writePlotManifest(outputs, plotHash):
+    fname = getPlotManifestName(outputs)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    hashes = {}
+    try:
+        with open(fname) as f:
+            hashes = json.load(f).get("outputs", {})
+    except (OSError, ValueError):
+        pass
+    hashes.update({os.path.basename(x) : plotHash for x in outputs})
+    with open(fname + ".tmp", "w") as f:
+        json.dump({"outputs" : hashes}, f)
+    os.replace(fname + ".tmp", fname)
+
+#########################################################################
+
 def getAxisRangeFromUser(axisNameTmp="", 
                          separator="::", 
                          rangeSeparator=","
@@ -288,7 +375,15 @@ def drawTH1(htmp,
             setLogy=False
             ):
 
-
+    styleArgs = {k : v for k,v in locals().items() if k not in ["htmp", "passCanvas"]}
+    outputs = [outdir + "{pfx}{hname}.{ext}".format(pfx=prefix,hname=("_"+outhistname) if len(outhistname) else "",ext=ext) for ext in getPlotFormats()]
+    if not outputs:
+        # no format to save now (e.g. all deferred)
+        return
+    plotHash = getPlotHash([htmp], styleArgs, passCanvas)
+    if isPlotUpToDate(outputs, plotHash):
+        logging.debug(f"Plot {outputs[0]} is unchanged, not saved again")
+        return
 
     addStringToEnd(outdir,"/",notAddIfEndswithMatch=True)
     createPlotDirAndCopyPhp(outdir)
@@ -344,11 +439,12 @@ def drawTH1(htmp,
             lat.DrawLatex(x1,y1-itx*ypass,tx)
 
             
-    for ext in ["png","pdf"]:
+    for output in outputs:
         if setLogy:
             canvas.SetLogy()
-        canvas.SaveAs(outdir + "{pfx}{hname}.{ext}".format(pfx=prefix,hname=("_"+outhistname) if len(outhistname) else "",ext=ext))
+        canvas.SaveAs(output)
     canvas.SetLogy(0)
+    writePlotManifest(outputs, plotHash)
 
 
 
@@ -382,6 +478,19 @@ def drawCorrelationPlot(h2D_tmp,
                         skipLumi=False
 ):
 
+    styleArgs = {k : v for k,v in locals().items() if k not in ["h2D_tmp", "passCanvas"]}
+    outputs = []
+    if (draw_both0_noLog1_onlyLog2 == 0 or draw_both0_noLog1_onlyLog2 == 1):
+        outputs += ['{od}/{cn}.{ext}'.format(od=outdir, cn=canvasName, ext=ext) for ext in getPlotFormats()]
+    if (draw_both0_noLog1_onlyLog2 == 0 or draw_both0_noLog1_onlyLog2 == 2):
+        outputs += ['{od}/{cn}_logZ.{ext}'.format(od=outdir, cn=canvasName, ext=ext) for ext in getPlotFormats()]
+    if not outputs:
+        # no format to save now (e.g. all deferred)
+        return
+    plotHash = getPlotHash([h2D_tmp], styleArgs, passCanvas)
+    if isPlotUpToDate(outputs, plotHash):
+        logging.debug(f"Plot {outputs[0]} is unchanged, not saved again")
+        return
 
     ROOT.TH1.SetDefaultSumw2()
     adjustSettings_CMS_lumi()
@@ -523,15 +632,15 @@ def drawCorrelationPlot(h2D_tmp,
     leg.Draw("same")
 
     if (draw_both0_noLog1_onlyLog2 == 0 or draw_both0_noLog1_onlyLog2 == 1):
-        for ext in ['png', 'pdf']:
-            canvas.SaveAs('{od}/{cn}.{ext}'.format(od=outdir, cn=canvasName, ext=ext))
+        saveCanvas(canvas, '{od}/{cn}'.format(od=outdir, cn=canvasName))
         
     if (draw_both0_noLog1_onlyLog2 == 0 or draw_both0_noLog1_onlyLog2 == 2):
         canvas.SetLogz()
-        for ext in ['png', 'pdf']:
-            canvas.SaveAs('{od}/{cn}_logZ.{ext}'.format(od=outdir, cn=canvasName, ext=ext))
+        saveCanvas(canvas, '{od}/{cn}_logZ'.format(od=outdir, cn=canvasName))
         canvas.SetLogz(0)
 
+    writePlotManifest(outputs, plotHash)
+
 
 ##########################################################
 
@@ -805,8 +914,7 @@ def drawSingleTH1(h1,
 
 
     if draw_both0_noLog1_onlyLog2 != 2:
-        canvas.SaveAs(outdir + canvasName + ".png")
-        canvas.SaveAs(outdir + canvasName + ".pdf")
+        saveCanvas(canvas, outdir + canvasName)
 
     if draw_both0_noLog1_onlyLog2 != 1:        
         if yAxisName == "a.u.": 
@@ -814,8 +922,7 @@ def drawSingleTH1(h1,
         else:
             h1.GetYaxis().SetRangeUser(max(0.001,h1.GetMinimum()*0.8),h1.GetMaximum()*100)
         canvas.SetLogy()
-        canvas.SaveAs(outdir + canvasName + "_logY.png")
-        canvas.SaveAs(outdir + canvasName + "_logY.pdf")
+        saveCanvas(canvas, outdir + canvasName + "_logY")
         canvas.SetLogy(0)
 
 
@@ -850,6 +957,20 @@ def drawNTH1(hists=[],
              palette=105 # palette for option drawLineMarkerAsPalette
 ):
 
+    styleArgs = {k : v for k,v in locals().items() if k not in ["hists", "passCanvas"]}
+    outputs = []
+    if draw_both0_noLog1_onlyLog2 != 2:
+        outputs += [f"{outdir}{canvasName}.{ext}" for ext in getPlotFormats()]
+    if draw_both0_noLog1_onlyLog2 != 1:
+        outputs += [f"{outdir}{canvasName}_logY.{ext}" for ext in getPlotFormats()]
+    if not outputs:
+        # no format to save now (e.g. all deferred)
+        return
+    plotHash = getPlotHash(hists, styleArgs, passCanvas)
+    if isPlotUpToDate(outputs, plotHash):
+        logging.debug(f"Plot {outputs[0]} is unchanged, not saved again")
+        return
+
     # moreText is used to pass some text to write somewhere (TPaveText is used)
     # e.g.  "stuff::x1,y1,x2,y2"  where xi and yi are the coordinates for the text
     # one can add more lines using the ";" key. FOr example, "stuff1;stuff2::x1,y1,x2,y2"
@@ -1191,8 +1312,7 @@ def drawNTH1(hists=[],
 
 
     if draw_both0_noLog1_onlyLog2 != 2:
-        canvas.SaveAs(outdir + canvasName + ".png")
-        canvas.SaveAs(outdir + canvasName + ".pdf")
+        saveCanvas(canvas, outdir + canvasName)
 
     if draw_both0_noLog1_onlyLog2 != 1:        
         if yAxisName == "a.u.": 
@@ -1200,10 +1320,11 @@ def drawNTH1(hists=[],
         else:
             h1.GetYaxis().SetRangeUser(max(0.001,h1.GetMinimum()*0.8),h1.GetMaximum()*100)
         canvas.SetLogy()
-        canvas.SaveAs(outdir + canvasName + "_logY.png")
-        canvas.SaveAs(outdir + canvasName + "_logY.pdf")
+        saveCanvas(canvas, outdir + canvasName + "_logY")
         canvas.SetLogy(0)
 
+    writePlotManifest(outputs, plotHash)
+
 
 ################################################################
 
@@ -1585,8 +1706,7 @@ def drawDataAndMC(h1, h2,
 
 
     if draw_both0_noLog1_onlyLog2 != 2:
-        canvas.SaveAs(outdir + canvasName + ".png")
-        canvas.SaveAs(outdir + canvasName + ".pdf")
+        saveCanvas(canvas, outdir + canvasName)
 
     if draw_both0_noLog1_onlyLog2 != 1:        
         if yAxisName == "a.u.": 
@@ -1594,8 +1714,7 @@ def drawDataAndMC(h1, h2,
         else:
             h1.GetYaxis().SetRangeUser(max(0.001,h1.GetMinimum()*0.8),h1.GetMaximum()*100)
         canvas.SetLogy()
-        canvas.SaveAs(outdir + canvasName + "_logY.png")
-        canvas.SaveAs(outdir + canvasName + "_logY.pdf")
+        saveCanvas(canvas, outdir + canvasName + "_logY")
         canvas.SetLogy(0)
         
           
@@ -1821,8 +1940,7 @@ def drawTH1dataMCstack(h1, thestack,
 
 
     if draw_both0_noLog1_onlyLog2 != 2:
-        canvas.SaveAs(outdir + canvasName + ".png")
-        canvas.SaveAs(outdir + canvasName + ".pdf")
+        saveCanvas(canvas, outdir + canvasName)
 
     if draw_both0_noLog1_onlyLog2 != 1:        
         if yAxisName == "a.u.": 
@@ -1830,8 +1948,7 @@ def drawTH1dataMCstack(h1, thestack,
         else:
             h1.GetYaxis().SetRangeUser(max(0.001,h1.GetMinimum()*0.8),h1.GetMaximum()*100)
             canvas.SetLogy()
-            canvas.SaveAs(outdir + canvasName + "_logY.png")
-            canvas.SaveAs(outdir + canvasName + "_logY.pdf")
+            saveCanvas(canvas, outdir + canvasName + "_logY")
             canvas.SetLogy(0)
             
 
@@ -1865,8 +1982,7 @@ def drawTH1dataMCstack(h1, thestack,
         ROOT.gStyle.SetOptStat(111110)
         ROOT.gStyle.SetOptFit(1102)
         _canvas_pull.RedrawAxis("sameaxis")
-        _canvas_pull.SaveAs(outdir + "pull_" + canvasName + ".png")    
-        _canvas_pull.SaveAs(outdir + "pull_" + canvasName + ".pdf")
+        saveCanvas(_canvas_pull, outdir + "pull_" + canvasName)
 
         if len(etaptbinning):
             _canvas_pull.SetGridx(0)
@@ -1895,8 +2011,7 @@ def drawTH1dataMCstack(h1, thestack,
             h2pull.GetZaxis().SetRangeUser(-3,3)
             h2pull.Draw("COLZ")
             _canvas_pull.RedrawAxis("sameaxis")
-            _canvas_pull.SaveAs(outdir + "pull2D_" + canvasName + ".png")
-            _canvas_pull.SaveAs(outdir + "pull2D_" + canvasName + ".pdf")
+            saveCanvas(_canvas_pull, outdir + "pull2D_" + canvasName)
 
             # add pulls for EE only
             _canvas_pull.SetTickx(1)
@@ -1940,8 +2055,7 @@ def drawTH1dataMCstack(h1, thestack,
             # pEEtext2.SetTextColor(ROOT.kBlue+2)
             # pEEtext2.DrawLatex(0.1,0.3,"#eta <= -1.5")
             _canvas_pull.RedrawAxis("sameaxis")
-            _canvas_pull.SaveAs(outdir + "pull_onlyEE_" + canvasName + ".png")    
-            _canvas_pull.SaveAs(outdir + "pull_onlyEE_" + canvasName + ".pdf")
+            saveCanvas(_canvas_pull, outdir + "pull_onlyEE_" + canvasName)
             
 #########################################################################
 
@@ -2257,8 +2371,7 @@ def drawMuElComparison(hlep, hmu, hel,
 
 
     if draw_both0_noLog1_onlyLog2 != 2:
-        canvas.SaveAs(outdir + canvasName + ".png")
-        canvas.SaveAs(outdir + canvasName + ".pdf")
+        saveCanvas(canvas, outdir + canvasName)
 
     if draw_both0_noLog1_onlyLog2 != 1:        
         if yAxisName == "a.u.": 
@@ -2266,8 +2379,7 @@ def drawMuElComparison(hlep, hmu, hel,
         else:
             hlep.GetYaxis().SetRangeUser(max(0.001,hlep.GetMinimum()*0.8),hlep.GetMaximum()*100)
         canvas.SetLogy()
-        canvas.SaveAs(outdir + canvasName + "_logY.png")
-        canvas.SaveAs(outdir + canvasName + "_logY.pdf")
+        saveCanvas(canvas, outdir + canvasName + "_logY")
         canvas.SetLogy(0)
         
           
@@ -2663,8 +2775,7 @@ def drawCheckTheoryBand(h1, h2, h3,
 
 
     if draw_both0_noLog1_onlyLog2 != 2:
-        canvas.SaveAs(outdir + canvasName + ".png")
-        canvas.SaveAs(outdir + canvasName + ".pdf")
+        saveCanvas(canvas, outdir + canvasName)
 
     if draw_both0_noLog1_onlyLog2 != 1:        
         if yAxisName == "a.u.": 
@@ -2672,8 +2783,7 @@ def drawCheckTheoryBand(h1, h2, h3,
         else:
             h1.GetYaxis().SetRangeUser(max(0.001,h1.GetMinimum()*0.8),h1.GetMaximum()*100)
         canvas.SetLogy()
-        canvas.SaveAs(outdir + canvasName + "_logY.png")
-        canvas.SaveAs(outdir + canvasName + "_logY.pdf")
+        saveCanvas(canvas, outdir + canvasName + "_logY")
         canvas.SetLogy(0)
 
 #########################################################################
@@ -3120,8 +3230,7 @@ def drawXsecAndTheoryband(h1, h2,  # h1 is data, h2 is total uncertainty band
         ROOT.gPad.RedrawAxis()
 
     if draw_both0_noLog1_onlyLog2 != 2:
-        canvas.SaveAs(outdir + canvasName + ".png")
-        canvas.SaveAs(outdir + canvasName + ".pdf")
+        saveCanvas(canvas, outdir + canvasName)
 
     if draw_both0_noLog1_onlyLog2 != 1:        
         if yAxisName == "a.u.": 
@@ -3129,8 +3238,7 @@ def drawXsecAndTheoryband(h1, h2,  # h1 is data, h2 is total uncertainty band
         else:
             h1.GetYaxis().SetRangeUser(max(0.001,h1.GetMinimum()*0.8),h1.GetMaximum()*100)
         canvas.SetLogy()
-        canvas.SaveAs(outdir + canvasName + "_logY.png")
-        canvas.SaveAs(outdir + canvasName + "_logY.pdf")
+        saveCanvas(canvas, outdir + canvasName + "_logY")
         canvas.SetLogy(0)
         
 
@@ -3357,5 +3465,4 @@ def drawGraphCMS(grList,
 
     canvas.RedrawAxis("sameaxis");
 
-    for ext in [".png",".pdf"]:
-        canvas.SaveAs(outputDIR+canvasName+ext)
+    saveCanvas(canvas, outputDIR+canvasName)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+import ROOT
+
+#########################################################################
+
+# While processing the input files one by one (or in a pool of jobs), the partial histograms are periodically saved in a
+# checkpoint file in the output directory, together with a TNamed whose title is a json string
+#   {"inputs" : fingerprint of all input files, "hashes" : {name : spec hash}, "completed" : [files already summed]}
+# so that a job that dies (e.g. for an xrootd error or a batch preemption) can be resumed, processing only the other files
+# A checkpoint is only valid for the same input files and the same specs of the histograms being filled
+# The file is written to a temporary name and then renamed, so that a job killed while writing it leaves the previous one
+
+checkpointInfoName = "checkpointInfo"
+
+#########################################################################
+
+class checkpointFile:
+
+    def __init__(self, fname, hashes, inputFingerprint, every=1):
+        # every: number of completed files after which the checkpoint is written again
+        self.fname = fname
+        self.hashes = hashes
+        self.inputFingerprint = inputFingerprint
+        self.every = max(1, every)
+        self.completed = []
+        self.nSinceWrite = 0
+
+    def load(self):
+
+        # return ({name : histogram}, completed files) from an existing checkpoint, or ({}, []) if there is none
+        # or it does not match the current inputs and specs
+        # the completed files are remembered, so that the next checkpoints include them
+
+        if not os.path.isfile(self.fname):
+            logging.warning(f"No checkpoint {self.fname} to resume from, all files will be processed")
+            return {},[]
+        tfile = ROOT.TFile.Open(self.fname)
+        if not tfile or tfile.IsZombie():
+            logging.warning(f"Cannot open checkpoint {self.fname}, all files will be processed")
+            return {},[]
+        histograms = {}
+        info = tfile.Get(checkpointInfoName)
+        info = json.loads(info.GetTitle()) if info else None
+        if info is None or info["inputs"] != self.inputFingerprint or info["hashes"] != self.hashes:
+            logging.warning(f"Checkpoint {self.fname} was made with different inputs or histograms, all files will be processed")
+        else:
+            for name in self.hashes:
+                h = tfile.Get(name)
+                if not h:
+                    break
+                h.SetDirectory(0)
+                histograms[name] = h
+            if len(histograms) == len(self.hashes):
+                self.completed = list(info["completed"])
+                logging.info(f"Resuming from checkpoint {self.fname}: {len(self.completed)} files already processed")
+            else:
+                logging.warning(f"Checkpoint {self.fname} is incomplete, all files will be processed")
+                histograms = {}
+        tfile.Close()
+        return histograms,list(self.completed)
+
+    def write(self, histograms):
+        tmp = self.fname + ".tmp"
+        tfile = ROOT.TFile.Open(tmp, "RECREATE")
+        tfile.cd()
+        for h in histograms.values():
+            h.Write(h.GetName(), ROOT.TObject.kOverwrite)
+        info = ROOT.TNamed(checkpointInfoName, json.dumps({"inputs"    : self.inputFingerprint,
+                                                           "hashes"    : self.hashes,
+                                                           "completed" : self.completed}, sort_keys=True))
+        info.Write()
+        tfile.Close()
+        os.replace(tmp, self.fname)
+        self.nSinceWrite = 0
+        logging.info(f"Checkpoint written with {len(self.completed)} files processed")
+
+    def fileDone(self, histograms, name):
+        # histograms ({name : histogram}) must already include the file
+        self.completed.append(name)
+        self.nSinceWrite += 1
+        if self.nSinceWrite >= self.every:
+            self.write(histograms)
+
+    def remove(self):
+        # called when the final output is saved, the checkpoint is not needed anymore
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import logging
+import ROOT
+
+from procUtils.rdfEngine import splitDrawExpression, resetStatsKeepingEntries
+from procUtils.histSpec import *
+from procUtils.inputFiles import *
+
+#########################################################################
+
+# Alternative to the RDataFrame engine, which reads the split leaves of the input trees in large columnar batches with uproot,
+# and fills the histograms with vectorized boost-histogram calls: no C++ code is compiled, and no CMSSW dictionary is needed
+# to read the EDM products. It needs the uproot, awkward, numpy and boost_histogram modules, which are only imported when
+# this engine is used. The filled histograms are copied in the usual ROOT model histograms, so the output is the same.
+#
+# Methods used in the draw expressions are mapped to the data members storing them,
+# e.g. EcalRecHitsSorted_reducedEcalRecHitsEB__RECO.obj.obj.energy() is read from the leaf ...obj.obj.energy_
+# while eta and phi are computed from the position of the object (e.g. for reco::CaloCluster)
+# Branches which are not split, like EventAuxiliary (CMSSW writes the auxiliary branches with split level 0), have no leaf
+# for the members: they are read as objects (deserialized by uproot with the streamers stored in the file),
+# and the members are taken from the resulting records, e.g. EventAuxiliary.run() is id_.run_
+
+_methodToMembers = {"energy"          : ["energy_"],
+                    "time"            : ["time_"],
+                    "run"             : ["id_", "run_"],
+                    "luminosityBlock" : ["id_", "luminosityBlock_"],
+                    "event"           : ["id_", "event_"]}
+
+_positionMethods = ["eta", "phi"]
+_positionMembers = ["position_", "fCoordinates"]
+
+#########################################################################
+
+def importColumnarModules():
+    try:
+        import numpy, awkward, uproot, boost_histogram
+    except ImportError as e:
+        logging.error(f"The columnar engine needs numpy, awkward, uproot and boost_histogram ({e}). Exit")
+        quit()
+    return numpy, awkward, uproot, boost_histogram
+
+#########################################################################
+
+def findLeaf(leafNames, branch, members):
+    # leaves of split EDM products are named as the full path, e.g. "X.obj.obj.energy_", look for the one
+    # under the given top level branch ending with the members, whatever the obj pieces in between
+    ending = ".".join(members)
+    for name in leafNames:
+        if name.startswith(branch) and name.endswith(f".{ending}"):
+            return name
+    return None
+
+#########################################################################
+
+def translateColumnarTerm(term, leafNames):
+
+    # return {"leaves" : leaves to read, "method" : method name} for a draw term like X.obj.obj.energy()
+    # size() can be obtained from the length of any of the other leaves of the collection, energy_ or the position is used
+
+    branch,_,rest = term.partition(".")
+    method = rest.split(".")[-1].rstrip("()")
+    if method == "size":
+        for members in [["energy_"], _positionMembers + ["fX"]]:
+            leaf = findLeaf(leafNames, branch, members)
+            if leaf:
+                return {"leaves" : [leaf], "method" : method}
+    elif method in _positionMethods:
+        leaves = [findLeaf(leafNames, branch, _positionMembers + [c]) for c in ["fX", "fY", "fZ"]]
+        if all(leaves):
+            return {"leaves" : leaves, "method" : method}
+    elif method in _methodToMembers:
+        leaf = findLeaf(leafNames, branch, _methodToMembers[method])
+        if leaf:
+            return {"leaves" : [leaf], "method" : method}
+        if branch in leafNames:
+            # unsplit branch, read as a whole
+            return {"leaves" : [branch], "members" : _methodToMembers[method], "method" : method}
+    raise RuntimeError(f"Error in translateColumnarTerm(): cannot find the leaves needed for '{term}', it can only be filled with the rdf engine")
+
+#########################################################################
+
+def evaluateColumnarTerm(batch, info):
+    np, ak, _, _ = importColumnarModules()
+    arrays = [batch[leaf] for leaf in info["leaves"]]
+    for member in info.get("members", []):
+        arrays = [a[member] for a in arrays]
+    if info["method"] == "size":
+        return ak.num(arrays[0], axis=-1)
+    elif info["method"] == "eta":
+        x,y,z = arrays
+        return np.arcsinh(z / np.sqrt(x**2 + y**2))
+    elif info["method"] == "phi":
+        x,y,_ = arrays
+        return np.arctan2(y, x)
+    return arrays[0]
+
+#########################################################################
+
+def copyBoostHistogramToRoot(bhist, h):
+    # bin contents including underflow and overflow have the same layout in boost_histogram (with flow=True) and ROOT,
+    # only the order of the axes is reversed in the flattening of the global bin number
+    np, _, _, _ = importColumnarModules()
+    values = np.asarray(bhist.view(flow=True), dtype=np.float64)
+    flat = values.flatten(order="F")
+    for ibin,val in enumerate(flat):
+        if val != 0.0:
+            h.SetBinContent(ibin, val)
+            if h.GetSumw2N():
+                h.SetBinError(ibin, np.sqrt(val))
+    h.SetEntries(float(flat.sum()))
+
+#########################################################################
+
+def getThresholdScanArrays(h, runs, values):
+    # same as defineThresholdScanColumns in rdfEngine: for each event and each threshold (lower edge of the z bins of h)
+    # the number of values above threshold, returned as flat arrays of run, count and threshold (bin center)
+    np, ak, _, _ = importColumnarModules()
+    zaxis = h.GetZaxis()
+    edges = [zaxis.GetBinLowEdge(i) for i in range(1, 1+zaxis.GetNbins())]
+    centers = np.array([zaxis.GetBinCenter(i) for i in range(1, 1+zaxis.GetNbins())])
+    counts = np.stack([ak.to_numpy(ak.sum(values >= edge, axis=-1)) for edge in edges], axis=1)
+    nEvents = counts.shape[0]
+    return (np.repeat(ak.to_numpy(runs).astype(np.float64), len(edges)),
+            counts.ravel().astype(np.float64),
+            np.tile(centers, nEvents))
+
+#########################################################################
+
+def fillHistogramsColumnar(files, registry, runAxis, treename="Events", stepSize="100 MB", storage="double"):
+
+    # fill the histograms defined in registry reading the files in batches, returns {name : histogram} and the number of entries read
+
+    np, ak, uproot, bh = importColumnarModules()
+
+    histsAndExprs,_ = compileHistogramSpecs(registry, runAxis, storage)
+    accessNames = [getFileAccessName(f) for f in files]
+    with uproot.open({accessNames[0] : treename}) as tree:
+        leafNames = tree.keys(recursive=True, full_paths=False)
+
+    terms = {}
+    bhists = {}
+    for h,extra in histsAndExprs.items():
+        for term in splitDrawExpression(extra[0]):
+            if term not in terms:
+                terms[term] = translateColumnarTerm(term, leafNames)
+        axes = [bh.axis.Variable([ax.GetBinLowEdge(i) for i in range(1, 2+ax.GetNbins())]) if ax.IsVariableBinSize()
+                else bh.axis.Regular(ax.GetNbins(), ax.GetXmin(), ax.GetXmax())
+                for ax in [h.GetXaxis(), h.GetYaxis(), h.GetZaxis()][:h.GetDimension()]]
+        bhists[h] = bh.Histogram(*axes, storage=bh.storage.Double())
+
+    leaves = sorted(set(leaf for info in terms.values() for leaf in info["leaves"]))
+    logging.info(f"Reading {len(leaves)} leaves with the columnar engine")
+    nEntries = 0
+    for ibatch,batch in enumerate(uproot.iterate({f : treename for f in accessNames}, filter_name=leaves, step_size=stepSize, library="ak")):
+        logging.debug(f"Processing batch {ibatch+1} with {len(batch)} entries")
+        nEntries += len(batch)
+        values = {term : evaluateColumnarTerm(batch, info) for term,info in terms.items()}
+        for h,extra in histsAndExprs.items():
+            arrays = [values[term] for term in splitDrawExpression(extra[0])]
+            if "thresholdScan" in extra[1:]:
+                bhists[h].fill(*getThresholdScanArrays(h, arrays[0], arrays[1]))
+                continue
+            threshold = getThresholdFromOptions(extra[1:])
+            if threshold != None:
+                bhists[h].fill(ak.to_numpy(arrays[0]).astype(np.float64),
+                               ak.to_numpy(ak.sum(arrays[1] >= threshold, axis=-1)).astype(np.float64))
+                continue
+            # scalars like the run number are broadcast to the jagged collections they are filled against
+            if any(a.ndim > 1 for a in arrays):
+                arrays = ak.broadcast_arrays(*arrays)
+            arrays = [ak.to_numpy(ak.flatten(a, axis=None)).astype(np.float64) for a in arrays]
+            bhists[h].fill(*arrays)
+
+    for h,bhist in bhists.items():
+        copyBoostHistogramToRoot(bhist, h)
+        resetStatsKeepingEntries(h)
+    return {h.GetName() : h for h in histsAndExprs}, nEntries
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import os
+import json
+import hashlib
+import logging
+import ROOT
+
+#########################################################################
+
+# The output file with all histograms is also used as a cache: together with the histograms it stores a TNamed
+# whose title is a json string {"inputs" : fingerprint of the input files, "hashes" : {name : spec hash}}
+# A histogram can be reused if both its spec hash and the input fingerprint did not change
+
+cacheInfoName = "histogramCacheInfo"
+
+#########################################################################
+
+def getInputFingerprint(files, selection=""):
+    # local files also contribute with size and modification time, so that a file replaced in place is noticed
+    # remote files are identified by their name only, to avoid opening them just to compute the fingerprint
+    # selection describes which events of the files are used (e.g. the selected runs), if not all
+    fingerprint = hashlib.sha1()
+    if selection:
+        fingerprint.update(f"selection:{selection}\n".encode())
+    for f in sorted(files):
+        fingerprint.update(f.encode())
+        if os.path.isfile(f):
+            stat = os.stat(f)
+            fingerprint.update(f":{stat.st_size}:{int(stat.st_mtime)}".encode())
+        fingerprint.update(b"\n")
+    return fingerprint.hexdigest()
+
+#########################################################################
+
+def readCacheInfo(tfile):
+    info = tfile.Get(cacheInfoName)
+    if not info:
+        return None
+    return json.loads(info.GetTitle())
+
+#########################################################################
+
+def writeCacheInfo(tfile, hashes, inputFingerprint):
+    # hashes should only contain the histograms actually written in the file
+    tfile.cd()
+    info = ROOT.TNamed(cacheInfoName, json.dumps({"inputs" : inputFingerprint, "hashes" : hashes}, sort_keys=True))
+    info.Write(cacheInfoName, ROOT.TObject.kOverwrite)
+
+#########################################################################
+
+def loadCachedHistograms(fname, hashes, inputFingerprint):
+
+    # return {name : histogram} for all histograms in fname still valid for the current specs and inputs
+    # histograms not in the file, or whose hash changed, are not returned and must be filled again
+
+    cached = {}
+    if not os.path.isfile(fname):
+        return cached
+    tfile = ROOT.TFile.Open(fname)
+    if not tfile or tfile.IsZombie():
+        logging.warning(f"Cannot open {fname}, histograms will not be taken from cache")
+        return cached
+    info = readCacheInfo(tfile)
+    if info is None:
+        logging.info(f"No cache information found in {fname}, all histograms will be filled")
+    elif info["inputs"] != inputFingerprint:
+        logging.info(f"Input files changed with respect to {fname}, all histograms will be filled")
+    else:
+        for name,specHash in hashes.items():
+            if info["hashes"].get(name) != specHash:
+                continue
+            h = tfile.Get(name)
+            if not h:
+                continue
+            h.SetDirectory(0)
+            cached[name] = h
+        logging.info(f"Taking {len(cached)}/{len(hashes)} histograms from cache {fname}")
+    tfile.Close()
+    return cached
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+import json
+import hashlib
+from array import array
+import logging
+import ROOT
+
+#########################################################################
+
+# A spec file contains a list of histograms under the key "histograms", each defined as
+#   name       : histogram name (also used for output plots)
+#   title      : histogram title, as in ROOT constructors (";x title;y title;z title")
+#   axes       : list of axes in x,y,z order, each being [nbins, low, high] or "run" for the run axis,
+#                whose binning is chosen at runtime (e.g. different for time-independent MC): the run axis is either
+#                [nbins, low, high] or {"edges" : [...]} with variable bins (e.g. one bin per run, see runAxis.py)
+#   expression : TTree::Draw-like expression ("z:y:x")
+#   options    : plotting options, e.g. "logz", "logy", "skipStatBox" (optional)
+#   iovProjection : whether to make and plot the projections for each IOV (optional, default true, only used for 2D)
+#   fill       : how the histogram is filled (optional), "plain" (default) as TTree::Draw would do, or "thresholdScan"
+#                for a TH3 with run, number of objects above threshold and threshold on the axes: the expression is then
+#                "collection:run", and for each event the number of objects with value at or above the lower edge of each bin
+#                of the threshold (z) axis is filled, so that any threshold can be selected later by projection
+#                or "countAboveThreshold", for a TH2 with the number of objects above threshold versus run, with expression
+#                "collection:run" as for thresholdScan: one histogram is made for each value in thresholds
+#   thresholdViews : thresholds for which the projections of a thresholdScan histogram are plotted (optional)
+#   thresholds : thresholds of a countAboveThreshold entry, which is expanded in one histogram for each of them, named
+#                name_thrX (with p instead of the decimal point); "{threshold}" in the title is replaced by the threshold
+#
+# Only name, axes, expression, fill and threshold affect the content of the histogram: they are used to compute the hash of each entry,
+# so that changing titles or plotting options does not require to refill the histogram
+
+_requiredKeys = ["name", "axes", "expression"]
+_optionalKeys = {"title" : "", "options" : [], "iovProjection" : True, "fill" : "plain", "thresholdViews" : [],
+                 "thresholds" : []}
+_fillModes = ["plain", "thresholdScan", "countAboveThreshold"]
+
+#########################################################################
+
+def getThresholdLabel(threshold):
+    # used in the names of histograms and plots, e.g. 0.5 -> 0p5
+    return f"{threshold:g}".replace(".", "p").replace("-", "m")
+
+#########################################################################
+
+def getThresholdFromOptions(opts):
+    # countAboveThreshold histograms carry their threshold as "aboveThreshold=X" among the options, None for the others
+    for opt in opts:
+        if opt.startswith("aboveThreshold="):
+            return float(opt.split("=")[1])
+    return None
+
+#########################################################################
+
+def expandThresholds(spec):
+    # one spec for each threshold of a countAboveThreshold entry, the others are returned as they are
+    if spec["fill"] != "countAboveThreshold":
+        return [spec]
+    specs = []
+    for thr in spec["thresholds"]:
+        thrSpec = dict(spec)
+        thrSpec["name"] = f"{spec['name']}_thr{getThresholdLabel(float(thr))}"
+        thrSpec["title"] = spec["title"].replace("{threshold}", f"{float(thr):g}")
+        thrSpec["threshold"] = float(thr)
+        specs.append(thrSpec)
+    return specs
+
+#########################################################################
+
+def readSpecFile(fname):
+    # json is always available, yaml only if the module is installed
+    with open(fname) as f:
+        if fname.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                logging.error(f"Spec file {fname} is in yaml format, but the yaml module is not available. Use json instead")
+                quit()
+            content = yaml.safe_load(f)
+        else:
+            content = json.load(f)
+    return content
+
+#########################################################################
+
+def loadHistogramSpecs(fname):
+
+    # return the registry of histogram specs, an ordered dictionary {name : spec}
+    # the order of the file is kept, since it is also the order used for processing and plotting
+
+    content = readSpecFile(fname)
+    registry = {}
+    for entry in content["histograms"]:
+        for key in _requiredKeys:
+            if key not in entry:
+                raise RuntimeError(f"Error in loadHistogramSpecs(): entry {entry} in {fname} has no key '{key}'")
+        name = entry["name"]
+        if name in registry:
+            raise RuntimeError(f"Error in loadHistogramSpecs(): histogram {name} is defined more than once in {fname}")
+        spec = {key : entry.get(key, default) for key,default in _optionalKeys.items()}
+        spec.update({key : entry[key] for key in _requiredKeys})
+        spec["axes"] = [ax if ax == "run" else [int(ax[0]), float(ax[1]), float(ax[2])] for ax in spec["axes"]]
+        if len(spec["axes"]) not in [1, 2, 3]:
+            raise RuntimeError(f"Error in loadHistogramSpecs(): histogram {name} has {len(spec['axes'])} axes, only 1 to 3 are supported")
+        if spec["fill"] not in _fillModes:
+            raise RuntimeError(f"Error in loadHistogramSpecs(): histogram {name} has unknown fill mode '{spec['fill']}', allowed values are {_fillModes}")
+        if spec["fill"] == "thresholdScan" and len(spec["axes"]) != 3:
+            raise RuntimeError(f"Error in loadHistogramSpecs(): histogram {name} uses thresholdScan, which needs 3 axes (run, number, threshold)")
+        if spec["fill"] == "countAboveThreshold" and (len(spec["axes"]) != 2 or not spec["thresholds"]):
+            raise RuntimeError(f"Error in loadHistogramSpecs(): histogram {name} uses countAboveThreshold, which needs 2 axes (run, number) and a list of thresholds")
+        for thrSpec in expandThresholds(spec):
+            if thrSpec["name"] in registry:
+                raise RuntimeError(f"Error in loadHistogramSpecs(): histogram {thrSpec['name']} is defined more than once in {fname}")
+            registry[thrSpec["name"]] = thrSpec
+    logging.info(f"Loaded {len(registry)} histogram specs from {fname}")
+    return registry
+
+#########################################################################
+
+def resolveAxes(spec, runAxis):
+    # replace the "run" placeholder with the actual run binning, passed as [nbins, low, high] or {"edges" : [...]}
+    if isinstance(runAxis, dict):
+        resolved = {"edges" : [float(x) for x in runAxis["edges"]]}
+    else:
+        resolved = [int(runAxis[0]), float(runAxis[1]), float(runAxis[2])]
+    return [resolved if ax == "run" else ax for ax in spec["axes"]]
+
+#########################################################################
+
+def getAxisEdges(ax):
+    # bin edges of an axis given as [nbins, low, high] or {"edges" : [...]}
+    if isinstance(ax, dict):
+        return ax["edges"]
+    nbins,low,high = ax
+    return [low + (high - low) * i / nbins for i in range(nbins)] + [high]
+
+#########################################################################
+
+def getSpecHash(spec, runAxis):
+    # stable content hash of the fields defining the histogram content, with the run axis already resolved
+    content = {"name"       : spec["name"],
+               "expression" : spec["expression"],
+               "axes"       : resolveAxes(spec, runAxis)}
+    # only added when not default, so that the hashes of existing histograms do not change
+    if spec["fill"] != "plain":
+        content["fill"] = spec["fill"]
+    if "threshold" in spec:
+        content["threshold"] = spec["threshold"]
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(",",":")).encode()).hexdigest()
+
+#########################################################################
+
+# Storage policies for the histograms, to reduce the memory used when there are many large histograms
+#   double  : TH*D with sum of squared weights (the default)
+#   nosumw2 : TH*D without sum of squared weights, the errors are the square root of the contents, which is the same for
+#             unweighted fills: this halves the memory also of the copies RDataFrame keeps for each thread
+#   float   : as nosumw2, with TH*F for the model and summed histograms (exact counts only up to 2^24 = 16777216 per bin),
+#             RDataFrame still fills TH*D (booked from a TH*D model with the same binning, see getHistogramModel in rdfEngine.py),
+#             which are converted when added to the models
+# Histograms which are scaled (e.g. with --sample-fraction) get the sum of squared weights when scaled, by ROOT itself
+
+storagePolicies = ["double", "nosumw2", "float"]
+_histogramClasses = {"double"  : [ROOT.TH1D, ROOT.TH2D, ROOT.TH3D],
+                     "nosumw2" : [ROOT.TH1D, ROOT.TH2D, ROOT.TH3D],
+                     "float"   : [ROOT.TH1F, ROOT.TH2F, ROOT.TH3F]}
+
+#########################################################################
+
+def applyStoragePolicy(storage):
+    # also applies to the histograms created by RDataFrame, so it must be called before booking them
+    ROOT.TH1.SetDefaultSumw2(storage == "double")
+
+#########################################################################
+
+def createModelHistogram(spec, runAxis, storage="double"):
+    axes = resolveAxes(spec, runAxis)
+    if any(isinstance(ax, dict) for ax in axes):
+        # with variable bins all axes are given as edges (TH3D has no constructor mixing fixed and variable bins)
+        binning = []
+        for ax in axes:
+            edges = getAxisEdges(ax)
+            binning += [len(edges) - 1, array("d", edges)]
+    else:
+        binning = [x for ax in axes for x in ax]
+    h = _histogramClasses[storage][len(axes)-1](spec["name"], spec["title"], *binning)
+    h.Sumw2(storage == "double")
+    h.SetDirectory(0)
+    return h
+
+#########################################################################
+
+def getPlotOptions(spec):
+    # options attached to the model histogram, used by the plotting (and by the event loop for the fill mode)
+    opts = list(spec["options"])
+    if not spec["iovProjection"]:
+        opts.append("noIOVprojection")
+    if spec["fill"] == "thresholdScan":
+        opts.append("thresholdScan")
+    if spec["fill"] == "countAboveThreshold":
+        opts.append(f"aboveThreshold={spec['threshold']!r}")
+    return opts
+
+#########################################################################
+
+def compileHistogramSpecs(registry, runAxis, storage="double"):
+
+    # create all model histograms at once, returning the {model histogram : [expression, options...]} dictionary
+    # used by the event loop and by the plotting, and {name : hash} for each entry
+    # (the storage policy does not change the content, so it does not enter the hash)
+
+    histsAndExprs = {}
+    hashes = {}
+    for name,spec in registry.items():
+        h = createModelHistogram(spec, runAxis, storage)
+        histsAndExprs[h] = [spec["expression"]] + getPlotOptions(spec)
+        hashes[name] = getSpecHash(spec, runAxis)
+        logging.debug(f"{name}: hash {hashes[name]}")
+    return histsAndExprs, hashes
+
+#########################################################################
+
+def getHistogramMemory(h):
+    # bytes used by the bin contents and, if present, by the sum of squared weights (all cells, with under/overflow)
+    contentBytes = 4 if h.InheritsFrom("TArrayF") else 8
+    return h.GetNcells() * contentBytes + h.GetSumw2N() * 8
+
+#########################################################################
+
+def printMemoryReport(hists, nThreads=1):
+
+    # memory used by each histogram, largest first, and in total
+    # RDataFrame also keeps one copy of each histogram for each thread (TH*D, with sum of squared weights unless
+    # the storage policy avoids it), which is what usually limits the number of jobs that fit in memory
+
+    if not hists:
+        return
+    sizes = sorted(((getHistogramMemory(h), h) for h in hists), key=lambda x: -x[0])
+    width = max(len(h.GetName()) for h in hists)
+    print()
+    print(f"{'histogram':<{width}}  {'class':<5}  {'cells':>9}  {'sumw2':>5}  {'MB':>8}")
+    print('-'*(width+37))
+    for size,h in sizes:
+        print(f"{h.GetName():<{width}}  {h.ClassName():<5}  {h.GetNcells():>9}  {'yes' if h.GetSumw2N() else 'no':>5}  {size/1e6:>8.2f}")
+    print('-'*(width+37))
+    total = sum(size for size,_ in sizes)
+    perThread = sum(h.GetNcells() * (16 if h.GetSumw2N() else 8) for h in hists)
+    print(f"{'total':<{width}}  {'':<5}  {sum(h.GetNcells() for h in hists):>9}  {'':>5}  {total/1e6:>8.2f}")
+    print(f"RDataFrame copies: {perThread/1e6:.2f} MB for each of the {max(1, nThreads)} threads of each event loop")
+    print()
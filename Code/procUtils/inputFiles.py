@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import os
+import json
+import logging
+import bisect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ROOT
+
+#########################################################################
+
+def getFileAccessName(n):
+    # files from DAS are given as /store/..., files on EOS can be read through xrootd
+    if n.startswith("/store/"):
+        return f"root://xrootd-cms.infn.it//{n}"
+    elif n.startswith("/eos/cms/"):
+        return n.replace('/eos/cms/','root://eoscms.cern.ch//')
+    else:
+        return n
+
+#########################################################################
+
+def getFileStat(name):
+    # [size, modification time] of a local or remote file, without opening it (for remote files ROOT asks the xrootd server)
+    # return None if the file cannot be found
+    stat = ROOT.FileStat_t()
+    if ROOT.gSystem.GetPathInfo(getFileAccessName(name), stat):
+        return None
+    return [int(stat.fSize), int(stat.fMtime)]
+
+#########################################################################
+
+class fileMetadataCache:
+
+    # sidecar json file with some information for each input file (e.g. the number of entries),
+    # keyed by the file name and only valid as long as size and modification time of the file are the same
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.data = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(fname):
+            with open(fname) as f:
+                self.data = json.load(f)
+
+    def get(self, name, stat):
+        with self.lock:
+            info = self.data.get(name)
+            if info is None or stat is None or [info["size"], info["mtime"]] != stat:
+                return None
+            return dict(info)
+
+    def update(self, name, stat, **info):
+        # information already stored for the same version of the file is kept
+        with self.lock:
+            old = self.data.get(name, {})
+            if [old.get("size"), old.get("mtime")] != stat:
+                old = {}
+            old.update(info)
+            old["size"],old["mtime"] = stat
+            self.data[name] = old
+
+    def save(self):
+        with self.lock:
+            if os.path.dirname(self.fname):
+                os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            tmp = self.fname + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.fname)
+
+#########################################################################
+
+def getCachedFileInfo(files, cache, key, compute, nWorkers=8, rebuild=False, isValid=None, derived=None):
+
+    # return {name : value} with the value of compute(name) for each file (None if it cannot be read), taken from the
+    # metadata cache under key when possible (unless rebuild is True, or isValid(value) is False, e.g. for an older format)
+    # derived(value), if given, returns other items to be stored in the cache together with it
+    # files are done concurrently, so that the time does not scale with the number of remote files
+    # (ROOT must be thread safe: EnableThreadSafety is called here, EnableImplicitMT also implies it)
+
+    ROOT.ROOT.EnableThreadSafety()
+
+    def getInfo(name):
+        stat = getFileStat(name)
+        info = cache.get(name, stat)
+        if not rebuild and info is not None and key in info and (isValid is None or isValid(info[key])):
+            return info[key]
+        value = compute(name)
+        if stat is not None and value is not None:
+            cache.update(name, stat, **{key : value}, **(derived(value) if derived != None else {}))
+        return value
+
+    with ThreadPoolExecutor(max_workers=max(1, nWorkers)) as pool:
+        values = dict(zip(files, pool.map(getInfo, files)))
+    cache.save()
+    return values
+
+#########################################################################
+
+def getClusterBoundaries(name, treename="Events"):
+    # first entry of each cluster of the tree, plus the total number of entries as last element
+    # clusters are the units in which baskets of all branches are flushed together, so ranges starting at these
+    # entries never need to read (and decompress) the same basket twice
+    tfile = ROOT.TFile.Open(getFileAccessName(name))
+    if not tfile or tfile.IsZombie():
+        logging.warning(f"Cannot open {name} to get its clusters")
+        return None
+    tree = tfile.Get(treename)
+    if not tree:
+        tfile.Close()
+        return None
+    entries = int(tree.GetEntries())
+    boundaries = []
+    clusterIter = tree.GetClusterIterator(0)
+    start = clusterIter.Next()
+    while start < entries:
+        boundaries.append(int(start))
+        start = clusterIter.Next()
+    boundaries.append(entries)
+    tfile.Close()
+    return boundaries
+
+#########################################################################
+
+def getCachedClusterBoundaries(name, cache, treename="Events", path=None):
+    # cluster boundaries as returned by getClusterBoundaries, taken from the cache if possible
+    # (name is the original file name, used for the cache, path the one actually read if different, e.g. a staged copy)
+    stat = getFileStat(name) if cache != None else None
+    info = cache.get(name, stat) if stat != None else None
+    if info != None and "clusters" in info:
+        return info["clusters"]
+    boundaries = getClusterBoundaries(path if path else name, treename)
+    if boundaries != None and stat != None:
+        cache.update(name, stat, clusters=boundaries, entries=boundaries[-1])
+    return boundaries
+
+#########################################################################
+
+def splitClustersIntoRanges(boundaries, nRanges):
+    # group consecutive clusters into at most nRanges entry ranges [start, stop) with similar number of entries
+    entries = boundaries[-1]
+    if nRanges <= 1 or len(boundaries) <= 2:
+        return [[0, entries]]
+    ranges = []
+    start = 0
+    for b in boundaries[1:-1]:
+        if b - start >= entries / nRanges and len(ranges) < nRanges - 1:
+            ranges.append([start, b])
+            start = b
+    ranges.append([start, entries])
+    return ranges
+
+#########################################################################
+
+def groupEntryRanges(ranges, nGroups, boundaries=None):
+    # split the entry ranges [start, stop) of a file (e.g. the clusters with the selected runs) into at most nGroups groups
+    # of consecutive ranges with similar number of entries, each group being a list of ranges where adjacent ones are merged
+    # if the cluster boundaries of the file are given, ranges are first cut at them, so that also a single large range can be split
+    units = []
+    for start,stop in sorted(ranges):
+        cuts = boundaries[bisect.bisect_right(boundaries, start):bisect.bisect_left(boundaries, stop)] if boundaries else []
+        edges = [start] + cuts + [stop]
+        units += [[first, last] for first,last in zip(edges[:-1], edges[1:])]
+    total = sum(last - first for first,last in units)
+    groups = []
+    done = 0
+    for first,last in units:
+        if not groups or (done >= total * len(groups) / nGroups and len(groups) < nGroups):
+            groups.append([])
+        if groups[-1] and groups[-1][-1][1] == first:
+            groups[-1][-1] = [groups[-1][-1][0], last]
+        else:
+            groups[-1].append([first, last])
+        done += last - first
+    return groups
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import logging
+import ROOT
+
+from procUtils.rdfEngine import *
+
+#########################################################################
+
+# Settings for reading the input trees, passed around as a dictionary so that they can be sent to the workers
+#   cacheSize     : size of the TTreeCache in bytes (0 disables the cache)
+#   learnEntries  : entries used by the TTreeCache to learn which branches are read; if 0, the needed branches
+#                   are added explicitly to the cache and the learning phase is skipped
+#   asyncPrefetch : prefetch the baskets asynchronously, in a separate thread
+# The TTreeCache of a TChain is set again for each file, but with implicit multithreading RDataFrame reads the trees
+# with its own chains, so the cache settings are only used for single-threaded event loops (the default with --jobs)
+
+def getReadSettings(cacheSizeMB=100, learnEntries=0, asyncPrefetch=False):
+    return {"cacheSize"     : int(cacheSizeMB * 1024 * 1024),
+            "learnEntries"  : int(learnEntries),
+            "asyncPrefetch" : bool(asyncPrefetch)}
+
+#########################################################################
+
+def applyGlobalReadSettings(settings):
+    # must be called before opening the files
+    if settings["asyncPrefetch"]:
+        ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
+
+#########################################################################
+
+def configureTreeCache(tree, branches, settings):
+    tree.SetCacheSize(settings["cacheSize"])
+    if settings["cacheSize"] <= 0:
+        return
+    if settings["learnEntries"] > 0:
+        tree.SetCacheLearnEntries(settings["learnEntries"])
+    else:
+        for b in branches:
+            tree.AddBranchToCache(getTopLevelBranchName(tree, b), True)
+        tree.StopCacheLearningPhase()
+    logging.debug(f"TTreeCache of {settings['cacheSize']/1024/1024:.0f} MB, learning entries = {settings['learnEntries']}")
+
+#########################################################################
+
+def getReadCounters():
+    # global counters of all files opened by this process
+    return {"readCalls" : ROOT.TFile.GetFileReadCalls(),
+            "bytesRead" : ROOT.TFile.GetFileBytesRead()}
+
+#########################################################################
+
+def getReadCountersDifference(after, before):
+    return {key : after[key] - before[key] for key in after}
+
+#########################################################################
+
+def printReadSummary(readStats):
+    # readStats is {file name : {"readCalls" : ..., "bytesRead" : ...}}
+    if not readStats:
+        return
+    width = max(len(name) for name in readStats)
+    print()
+    print(f"{'file':<{width}}  {'read calls':>10}  {'MB read':>10}  {'kB/call':>8}")
+    print('-'*(width+36))
+    for name,stats in readStats.items():
+        perCall = stats["bytesRead"] / stats["readCalls"] / 1024 if stats["readCalls"] else 0.0
+        print(f"{name:<{width}}  {stats['readCalls']:>10}  {stats['bytesRead']/1e6:>10.1f}  {perCall:>8.1f}")
+    print('-'*(width+36))
+    totCalls = sum(s["readCalls"] for s in readStats.values())
+    totBytes = sum(s["bytesRead"] for s in readStats.values())
+    print(f"{'total':<{width}}  {totCalls:>10}  {totBytes/1e6:>10.1f}  {totBytes/totCalls/1024 if totCalls else 0.0:>8.1f}")
+    print()
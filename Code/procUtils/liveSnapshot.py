@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+import ROOT
+
+#########################################################################
+
+# Partial histograms can be published while the job is running, so that problems can be spotted early in long jobs
+# A snapshot of the histograms summed so far is written in a side file every N events or every T seconds (whichever
+# comes first), and a render function can be given to remake some key plots from it
+# Histograms are summed one shard at a time (a file, or an entry range of a file), so snapshots cannot be more frequent
+# than that: with everyEvents the files are split in cluster-aligned ranges of about that many entries (see fillHistogramsInPool),
+# otherwise --ranges-per-file makes the shards smaller
+
+#########################################################################
+
+class liveSnapshot:
+
+    def __init__(self, fname, everyEvents=0, everySeconds=0.0, render=None):
+        # everyEvents or everySeconds equal to 0 disables that condition
+        # render is called as render({name : histogram}) after each snapshot is written
+        self.fname = fname
+        self.everyEvents = everyEvents
+        self.everySeconds = everySeconds
+        self.render = render
+        self.entriesSinceWrite = 0
+        self.lastWrite = time.time()
+        self.nSnapshots = 0
+
+    def isDue(self):
+        if self.everyEvents > 0 and self.entriesSinceWrite >= self.everyEvents:
+            return True
+        if self.everySeconds > 0 and time.time() - self.lastWrite >= self.everySeconds:
+            return True
+        return False
+
+    def update(self, histograms, entries):
+        # histograms ({name : histogram}) must already include the shard with the given number of entries
+        self.entriesSinceWrite += entries
+        if self.isDue():
+            self.write(histograms)
+
+    def write(self, histograms):
+        tmp = self.fname + ".tmp"
+        tfile = ROOT.TFile.Open(tmp, "RECREATE")
+        tfile.cd()
+        for h in histograms.values():
+            h.Write(h.GetName(), ROOT.TObject.kOverwrite)
+        tfile.Close()
+        os.replace(tmp, self.fname)
+        self.nSnapshots += 1
+        logging.info(f"Live snapshot {self.nSnapshots} written in {self.fname} ({self.entriesSinceWrite} new entries)")
+        self.entriesSinceWrite = 0
+        self.lastWrite = time.time()
+        if self.render != None:
+            try:
+                self.render(histograms)
+            except Exception as e:
+                # plots are only for monitoring, they should never stop the processing
+                logging.warning(f"Could not make the plots of the live snapshot ({e})")
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+import re
+import os
+import logging
+from array import array
+import ROOT
+
+from procUtils.histSpec import getThresholdFromOptions
+
+#########################################################################
+
+# a TTree::Draw term like "EcalRecHitsSorted_reducedEcalRecHitsEB__RECO.obj.obj.energy()" or "EventAuxiliary.run()"
+# the "obj" pieces are just how the EDM wrapper and SortedCollection store data, in C++ we can iterate on the product directly
+_drawTermRegexp = re.compile(r"^(?P<branch>[A-Za-z_]\w*)\.(?P<path>(?:obj\.)*)(?P<method>\w+)\(\)$")
+
+#########################################################################
+
+def loadMacros(macros):
+    # compile with ACLiC (or only load, if the library is up to date) the C++ functions used in the expressions,
+    # and optimize the code jitted by RDataFrame: only needed by this engine, in the main process and in each process of the pools
+    ROOT.gInterpreter.ProcessLine(".O3")
+    for x in macros:
+        if "/" + os.path.basename(x).replace(".", "_") + ".so" in ROOT.gSystem.GetLibraries():
+            continue
+        if not ROOT.gSystem.CompileMacro(x, "k"):
+            raise RuntimeError(f"Error in loadMacros(): loading and compiling {x} failed")
+
+#########################################################################
+
+def splitDrawExpression(expr):
+    # TTree::Draw uses "z:y:x", return terms ordered as x,y,z
+    # do not split on "::", just in case some C++ scope is used in the expression
+    terms = [t.strip() for t in re.split(r"(?<!:):(?!:)", expr)]
+    return terms[::-1]
+
+#########################################################################
+
+def getColumnNameFromTerm(term):
+    # make a valid C++ identifier out of the draw term, used as name of the RDF column
+    name = re.sub(r"\.(obj\.)*", "_", term)
+    name = re.sub(r"\W", "", name)
+    return name
+
+#########################################################################
+
+def isEdmProductBranch(tree, branch):
+    # EDM products are stored in a top level branch with a trailing dot, wrapping the product in edm::Wrapper
+    return bool(tree.GetBranch(f"{branch}."))
+
+#########################################################################
+
+def translateDrawTerm(term, tree):
+
+    # return a dictionary with the C++ expression to be used in RDF::Define, the name of the column it defines,
+    # whether the column is a collection (RVec) or a scalar, and the top level branch it needs
+
+    match = _drawTermRegexp.match(term)
+    if not match:
+        raise RuntimeError(f"Error in translateDrawTerm(): cannot translate '{term}' into a RDataFrame column")
+    branch = match.group("branch")
+    path = match.group("path")
+    method = match.group("method")
+
+    ret = {"column" : getColumnNameFromTerm(term),
+           "branch" : branch,
+           "alias"  : None,
+           "isCollection" : False}
+
+    if not isEdmProductBranch(tree, branch):
+        if path:
+            raise RuntimeError(f"Error in translateDrawTerm(): '{term}' uses obj but {branch} is not an EDM product")
+        ret["expr"] = f"double({branch}.{method}())"
+        return ret
+
+    # alias the wrapper branch, whose name ends with a dot, to a valid C++ identifier
+    alias = f"{branch}_wrapper"
+    ret["alias"] = (alias, f"{branch}.")
+    if method == "size":
+        ret["expr"] = f"{alias}.isPresent() ? double({alias}.product()->size()) : 0.0"
+    else:
+        ret["isCollection"] = True
+        ret["expr"] = (f"ROOT::RVec<double> values; "
+                       f"if ({alias}.isPresent()) {{ "
+                       f"values.reserve({alias}.product()->size()); "
+                       f"for (auto const& obj : *({alias}.product())) values.push_back(obj.{method}()); "
+                       f"}} "
+                       f"return values;")
+    return ret
+
+#########################################################################
+
+def getTopLevelBranchName(tree, branch):
+    return f"{branch}." if isEdmProductBranch(tree, branch) else branch
+
+#########################################################################
+
+def getBranchesFromExpressions(exprs, tree):
+    # names of the top level branches referenced by the draw expressions, e.g. EventAuxiliary for EventAuxiliary.run()
+    branches = []
+    for expr in exprs:
+        for term in splitDrawExpression(expr):
+            branch = translateDrawTerm(term, tree)["branch"]
+            if branch not in branches:
+                branches.append(branch)
+    return branches
+
+#########################################################################
+
+def pruneBranches(tree, branches):
+    # disable everything but the given top level branches and their sub-branches
+    tree.SetBranchStatus("*", 0)
+    for b in branches:
+        name = getTopLevelBranchName(tree, b)
+        tree.SetBranchStatus(name, 1)
+        br = tree.GetBranch(name)
+        if br and br.GetListOfBranches().GetEntries():
+            tree.SetBranchStatus(f"{name.rstrip('.')}.*", 1)
+
+#########################################################################
+
+def reportBranchPruning(tree, branches):
+
+    # compare the compressed size of the branches needed by the expressions with what was read before, i.e. all branches but recoMuon*
+    # sizes refer to the tree currently loaded (the first file for a chain), the proportion should be similar for the other files
+
+    tree.LoadTree(0)
+    currentTree = tree.GetTree()
+    if not currentTree:
+        return
+    allBytes = 0
+    for b in currentTree.GetListOfBranches():
+        if not b.GetName().startswith("recoMuon"):
+            allBytes += b.GetZipBytes("*")
+    neededBytes = 0
+    for b in branches:
+        br = currentTree.GetBranch(getTopLevelBranchName(currentTree, b))
+        if br:
+            neededBytes += br.GetZipBytes("*")
+    fraction = neededBytes / allBytes if allBytes > 0 else 0.0
+    logging.info(f"Reading {len(branches)} branches out of {currentTree.GetListOfBranches().GetEntries()}")
+    logging.info(f"Compressed size in {currentTree.GetCurrentFile().GetName()}: {neededBytes/1e6:.1f} MB, instead of {allBytes/1e6:.1f} MB reading all branches ({100.*fraction:.1f}%)")
+    for b in branches:
+        logging.debug(f"    {b}")
+
+#########################################################################
+
+def applyRunSelection(df, tree, runRanges, runExpression="EventAuxiliary.run()"):
+    # keep only the events whose run is in one of the ranges [first, last] (both included)
+    info = translateDrawTerm(runExpression, tree)
+    condition = " || ".join(f"(run >= {first} && run <= {last})" for first,last in runRanges)
+    logging.debug(f"Selecting runs with {condition}")
+    return df.Filter(f"const double run = {info['expr']}; return {condition};", "run selection")
+
+#########################################################################
+
+def applyEntrySelection(df, entryRanges):
+    # keep only the entries in one of the ranges [start, stop), only valid in single-threaded event loops,
+    # where rdfentry_ is the entry number of the tree
+    condition = " || ".join(f"(rdfentry_ >= {start} && rdfentry_ < {stop})" for start,stop in entryRanges)
+    return df.Filter(condition, "entry selection")
+
+#########################################################################
+
+def defineThresholdScanColumns(df, h, valuesColumn, runColumn):
+
+    # for each event, count the objects with value at or above the lower edge of each bin of the z axis of h (the thresholds),
+    # sorting the values once and using a binary search for each threshold
+    # the counts are filled at the bin centers, to avoid any rounding issue at the bin edges
+    # return the dataframe and the columns for x (run), y (count) and z (threshold)
+
+    zaxis = h.GetZaxis()
+    edges = ", ".join(repr(zaxis.GetBinLowEdge(i)) for i in range(1, 1+zaxis.GetNbins()))
+    centers = ", ".join(repr(zaxis.GetBinCenter(i)) for i in range(1, 1+zaxis.GetNbins()))
+    prefix = f"{h.GetName()}_thrScan"
+    df = df.Define(f"{prefix}_count",
+                   f"const ROOT::RVec<double> edges = {{{edges}}}; "
+                   f"auto sorted = ROOT::VecOps::Sort({valuesColumn}); "
+                   f"ROOT::RVec<double> counts(edges.size()); "
+                   f"for (size_t i = 0; i < edges.size(); ++i) counts[i] = sorted.end() - std::lower_bound(sorted.begin(), sorted.end(), edges[i]); "
+                   f"return counts;")
+    df = df.Define(f"{prefix}_threshold", f"ROOT::RVec<double>{{{centers}}}")
+    df = df.Define(f"{prefix}_run", f"ROOT::RVec<double>({prefix}_count.size(), {runColumn})")
+    return df, [f"{prefix}_run", f"{prefix}_count", f"{prefix}_threshold"]
+
+#########################################################################
+
+def defineCountAboveThresholdColumns(df, valuesColumn, thresholds):
+
+    # for each threshold applied to the collection, the number of values at or above it is a single vectorized reduction
+    # per event, Sum(values >= threshold): for a few thresholds this is cheaper than sorting the values as for thresholdScan
+    # return the dataframe and {threshold : name of the column with the count}
+
+    columns = {}
+    for i,thr in enumerate(sorted(thresholds)):
+        columns[thr] = f"{valuesColumn}_countAboveThr_{i}"
+        df = df.Define(columns[thr], f"ROOT::VecOps::Sum({valuesColumn} >= {thr!r})")
+    return df, columns
+
+#########################################################################
+
+def getHistogramModel(h):
+    # RDataFrame model for the model histogram h: the models can only be made from TH*D, so for the other types
+    # (e.g. TH*F with the float storage policy) a TH*D model with the same name, title and binning is made,
+    # and h is only the target where the filled histogram is added
+    dim = h.GetDimension()
+    models = {1 : ROOT.RDF.TH1DModel, 2 : ROOT.RDF.TH2DModel, 3 : ROOT.RDF.TH3DModel}
+    if dim not in models:
+        raise RuntimeError(f"Error in getHistogramModel(): unsupported histogram's dimension ({dim})")
+    if isinstance(h, (ROOT.TH1D, ROOT.TH2D, ROOT.TH3D)):
+        return models[dim](h)
+    axes = [h.GetXaxis(), h.GetYaxis(), h.GetZaxis()][:dim]
+    if any(ax.IsVariableBinSize() for ax in axes):
+        # as in createModelHistogram, all axes are given as edges (TH3DModel has no constructor mixing fixed and variable bins)
+        binning = []
+        for ax in axes:
+            binning += [ax.GetNbins(), array("d", [ax.GetBinLowEdge(i) for i in range(1, 2+ax.GetNbins())])]
+    else:
+        binning = [x for ax in axes for x in (ax.GetNbins(), ax.GetXmin(), ax.GetXmax())]
+    return models[dim](h.GetName(), h.GetTitle(), *binning)
+
+#########################################################################
+
+def bookHistograms(df, histsAndExprs, tree):
+
+    # book one lazy fill per histogram on the same dataframe, so that all of them are filled in a single event loop
+    # histsAndExprs is the usual {model histogram : [draw expression, options...]} dictionary
+    # tree is only used to inspect the branches (needed to know which ones are EDM products)
+    # returns a dictionary {model histogram : RResultPtr}
+
+    definedColumns = {}
+    broadcastColumns = set()
+    aliases = set()
+    booked = {}
+    aboveThreshold = {}
+
+    for h,extra in histsAndExprs.items():
+
+        terms = splitDrawExpression(extra[0])
+        thresholdScan = "thresholdScan" in extra[1:]
+        threshold = getThresholdFromOptions(extra[1:])
+        nTerms = 2 if thresholdScan or threshold != None else h.GetDimension()
+        if len(terms) != nTerms:
+            raise RuntimeError(f"Error in bookHistograms(): expression '{extra[0]}' has {len(terms)} terms but {h.GetName()} needs {nTerms}")
+
+        columns = []
+        for term in terms:
+            if term not in definedColumns:
+                info = translateDrawTerm(term, tree)
+                if info["alias"] and info["alias"][0] not in aliases:
+                    df = df.Alias(*info["alias"])
+                    aliases.add(info["alias"][0])
+                logging.debug(f"Defining column {info['column']} = {info['expr']}")
+                df = df.Define(info["column"], info["expr"])
+                definedColumns[term] = info
+            columns.append(definedColumns[term])
+
+        if thresholdScan:
+            if columns[0]["isCollection"] or not columns[1]["isCollection"]:
+                raise RuntimeError(f"Error in bookHistograms(): thresholdScan for {h.GetName()} needs an expression like 'collection:run'")
+            df,colNames = defineThresholdScanColumns(df, h, columns[1]["column"], columns[0]["column"])
+            booked[h] = df.Histo3D(getHistogramModel(h), *colNames)
+            logging.debug(f"Booked {h.GetName()} with columns {colNames}")
+            continue
+
+        if threshold != None:
+            # booked at the end, when all the thresholds for the same collection are known
+            if columns[0]["isCollection"] or not columns[1]["isCollection"]:
+                raise RuntimeError(f"Error in bookHistograms(): countAboveThreshold for {h.GetName()} needs an expression like 'collection:run'")
+            aboveThreshold.setdefault(columns[1]["column"], []).append((h, threshold, columns[0]["column"]))
+            continue
+
+        # a collection filled against a scalar (e.g. energy vs run): broadcast the scalar to the collection size,
+        # so that all columns passed to the fill have the same length
+        collections = [c for c in columns if c["isCollection"]]
+        colNames = []
+        for c in columns:
+            if collections and not c["isCollection"]:
+                ref = collections[0]["column"]
+                bname = f"{c['column']}_as_{ref}"
+                if bname not in broadcastColumns:
+                    df = df.Define(bname, f"ROOT::RVec<double>({ref}.size(), {c['column']})")
+                    broadcastColumns.add(bname)
+                colNames.append(bname)
+            else:
+                colNames.append(c["column"])
+
+        dim = h.GetDimension()
+        if dim == 1:
+            booked[h] = df.Histo1D(getHistogramModel(h), *colNames)
+        elif dim == 2:
+            booked[h] = df.Histo2D(getHistogramModel(h), *colNames)
+        elif dim == 3:
+            booked[h] = df.Histo3D(getHistogramModel(h), *colNames)
+        else:
+            raise RuntimeError(f"Error in bookHistograms(): unsupported histogram's dimension ({dim})")
+        logging.debug(f"Booked {h.GetName()} with columns {colNames}")
+
+    for valuesColumn,entries in aboveThreshold.items():
+        df,countColumns = defineCountAboveThresholdColumns(df, valuesColumn, set(thr for _,thr,_ in entries))
+        for h,thr,runColumn in entries:
+            booked[h] = df.Histo2D(getHistogramModel(h), runColumn, countColumns[thr])
+            logging.debug(f"Booked {h.GetName()} with columns {[runColumn, countColumns[thr]]}")
+
+    return booked
+
+#########################################################################
+
+def resetStatsKeepingEntries(h):
+    # recompute the statistics (sum of weights, means, etc.) from the bin contents
+    # with multithreading or multiprocessing the partial statistics are summed in an order which is not reproducible,
+    # and since they are sums of large numbers (e.g. run^2) the result can change in the last bits from run to run,
+    # while the bin contents are integer counts and are always exactly the same
+    entries = h.GetEntries()
+    h.ResetStats()
+    h.SetEntries(entries)
+
+#########################################################################
+
+def runEventLoop(booked):
+
+    # trigger the single event loop (the first GetValue runs all booked actions together),
+    # then copy the result into the model histograms, which keep the axis titles and are used downstream
+    if not booked:
+        return
+    logging.info(f"Running the event loop for {len(booked)} histograms")
+    for h,result in booked.items():
+        h.Add(result.GetValue())
+        h.SetDirectory(0)
+        resetStatsKeepingEntries(h)
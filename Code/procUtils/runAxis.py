@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import logging
+
+import ROOT
+
+from procUtils.rdfEngine import translateDrawTerm
+from procUtils.inputFiles import *
+from procUtils.histSpec import getAxisEdges
+
+#########################################################################
+
+# The run axis is normally a fixed binning, chosen a priori, where most bins are empty and close runs can end up in the same bin
+# With a quick pre-scan of the input files, only reading EventAuxiliary, the list of runs can be known in advance,
+# and the run axis made with exactly one bin for each run: the bin edges are half way between consecutive runs,
+# so there are no empty bins and no two runs in the same bin (bins have different widths, but each bin is one run)
+# The runs of each file are kept in the file metadata cache, so the pre-scan is only done once for each file
+
+runExpression = "EventAuxiliary.run()"
+
+#########################################################################
+
+def getRunsInFile(name, treename="Events"):
+    # sorted list of distinct runs in the file, or None if it cannot be read
+    tfile = ROOT.TFile.Open(getFileAccessName(name))
+    if not tfile or tfile.IsZombie():
+        logging.warning(f"Cannot open {name} to get its runs")
+        return None
+    tree = tfile.Get(treename)
+    if not tree:
+        tfile.Close()
+        return None
+    info = translateDrawTerm(runExpression, tree)
+    rdf = ROOT.RDataFrame(tree).Define(info["column"], info["expr"])
+    runs = sorted(set(int(r) for r in rdf.Take["double"](info["column"]).GetValue()))
+    tfile.Close()
+    return runs
+
+#########################################################################
+
+def getRunList(files, cache, treename="Events", nWorkers=8):
+    # sorted list of the distinct runs in all files, taken from the cache when possible (also filled when the files are indexed,
+    # see runIndex.py), otherwise the files are scanned concurrently
+    runsPerFile = getCachedFileInfo(files, cache, "runs", lambda name: getRunsInFile(name, treename), nWorkers=nWorkers)
+    return sorted(set(r for runs in runsPerFile.values() if runs is not None for r in runs))
+
+#########################################################################
+
+def getRunAxisEdges(runs):
+    # one bin for each run, with edges half way between consecutive runs
+    runs = sorted(runs)
+    edges = [runs[0] - 0.5]
+    edges += [0.5 * (runs[i-1] + runs[i]) for i in range(1, len(runs))]
+    edges.append(runs[-1] + 0.5)
+    return edges
+
+#########################################################################
+
+def getExactRunAxis(files, cache, treename="Events"):
+    # run axis in the format used by the histogram specs, or None if no run could be found
+    runs = getRunList(files, cache, treename)
+    if not runs:
+        logging.warning("No runs found in the pre-scan of the input files, the default run axis is used")
+        return None
+    logging.info(f"Found {len(runs)} runs in the input files, from {runs[0]} to {runs[-1]}")
+    return {"edges" : getRunAxisEdges(runs)}
+
+#########################################################################
+
+def getRunsOfIOV(runs, runAxis, iov):
+    # IOVs are the non empty bins of the run axis (as in the projections made for the plots), numbered from 1
+    edges = getAxisEdges(runAxis) if isinstance(runAxis, dict) else getAxisEdges([int(runAxis[0]), float(runAxis[1]), float(runAxis[2])])
+    runsInBin = {}
+    for run in runs:
+        ibin = next((i for i in range(len(edges)-1) if edges[i] <= run < edges[i+1]), None)
+        if ibin != None:
+            runsInBin.setdefault(ibin, []).append(run)
+    iovs = [runsInBin[ibin] for ibin in sorted(runsInBin)]
+    if iov < 1 or iov > len(iovs):
+        raise RuntimeError(f"Error in getRunsOfIOV(): IOV {iov} requested, but there are {len(iovs)} IOVs in the input files")
+    logging.info(f"IOV {iov} has runs {iovs[iov-1]}")
+    return iovs[iov-1]
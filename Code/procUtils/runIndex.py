@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import logging
+
+import ROOT
+
+from procUtils.rdfEngine import translateDrawTerm
+from procUtils.inputFiles import *
+
+#########################################################################
+
+# Index of the runs and lumisections in each input file, kept in the file metadata cache as
+#   "runIndex" : {"version"     : runIndexVersion (indices of other versions are built again),
+#                 "runs"        : {run : {"entries" : number of entries, "lumis" : [sorted lumisections]}},
+#                 "clusters"    : first entry of each cluster, plus the number of entries as last element,
+#                 "clusterRuns" : [sorted runs in each cluster]}
+# (json keys are strings, so runs are stored as strings in "runs")
+# When only some runs are needed, the index tells which files can be skipped altogether, and which clusters of the
+# other files need to be read, without opening any file
+
+_indexTerms = {"run" : "EventAuxiliary.run()", "lumi" : "EventAuxiliary.luminosityBlock()"}
+# version 1 could assign runs to the wrong clusters, since the entries were read with multithreading (not in entry order)
+runIndexVersion = 2
+
+#########################################################################
+
+def buildFileRunIndex(name, treename="Events"):
+    # read run and lumisection of each entry (only EventAuxiliary), return the index of the file or None if it cannot be read
+    # the event loop must be single-threaded, so that the values are taken in entry order (see getRunIndex)
+    boundaries = getClusterBoundaries(name, treename)
+    if boundaries == None:
+        logging.warning(f"Cannot read {name} to index its runs")
+        return None
+    tfile = ROOT.TFile.Open(getFileAccessName(name))
+    tree = tfile.Get(treename)
+    rdf = ROOT.RDataFrame(tree)
+    taken = {}
+    for key,term in _indexTerms.items():
+        info = translateDrawTerm(term, tree)
+        rdf = rdf.Define(info["column"], info["expr"])
+        taken[key] = rdf.Take["double"](info["column"])
+    runs = [int(r) for r in taken["run"].GetValue()]
+    lumis = [int(l) for l in taken["lumi"].GetValue()]
+    tfile.Close()
+
+    index = {"version" : runIndexVersion, "runs" : {}, "clusters" : boundaries, "clusterRuns" : []}
+    runLumis = {}
+    for run,lumi in zip(runs, lumis):
+        runLumis.setdefault(run, set()).add(lumi)
+        entry = index["runs"].setdefault(str(run), {"entries" : 0, "lumis" : []})
+        entry["entries"] += 1
+    for run,lumiSet in runLumis.items():
+        index["runs"][str(run)]["lumis"] = sorted(lumiSet)
+    for start,stop in zip(boundaries[:-1], boundaries[1:]):
+        index["clusterRuns"].append(sorted(set(runs[start:stop])))
+    return index
+
+#########################################################################
+
+def getRunIndex(files, cache, treename="Events", nWorkers=8, rebuild=False):
+
+    # return {name : index} for all files (None for those which cannot be read), taken from the cache when possible
+    # the runs, entries and clusters found are also stored in the cache for the other users
+    # files are indexed concurrently, but each with a single-threaded event loop: implicit multithreading is
+    # disabled meanwhile (and enabled again afterwards), since Take does not keep the entry order with it
+
+    nThreads = ROOT.ROOT.GetThreadPoolSize() if ROOT.ROOT.IsImplicitMTEnabled() else 0
+    if nThreads:
+        ROOT.ROOT.DisableImplicitMT()
+    try:
+        return getCachedFileInfo(files, cache, "runIndex", lambda name: buildFileRunIndex(name, treename), nWorkers=nWorkers, rebuild=rebuild,
+                                 isValid=lambda index: index.get("version") == runIndexVersion,
+                                 derived=lambda index: {"runs"     : sorted(int(r) for r in index["runs"]),
+                                                        "entries"  : index["clusters"][-1],
+                                                        "clusters" : index["clusters"]})
+    finally:
+        if nThreads:
+            ROOT.ROOT.EnableImplicitMT(nThreads)
+
+#########################################################################
+
+def getRunsFromIndex(indices):
+    # sorted list of the distinct runs in all indexed files
+    return sorted(set(int(r) for index in indices.values() if index is not None for r in index["runs"]))
+
+#########################################################################
+
+def getEntryRangesForRuns(index, runs):
+    # entry ranges [start, stop) of the file with the given index covering all entries of the runs, merging consecutive clusters
+    # an empty list means the file has none of the runs
+    runs = set(runs)
+    ranges = []
+    clusters = index["clusters"]
+    for i,clusterRuns in enumerate(index["clusterRuns"]):
+        if not runs.intersection(clusterRuns):
+            continue
+        if ranges and ranges[-1][1] == clusters[i]:
+            ranges[-1][1] = clusters[i+1]
+        else:
+            ranges.append([clusters[i], clusters[i+1]])
+    return ranges
+
+#########################################################################
+
+def printRunIndexSummary(indices):
+    width = max([len(name) for name in indices] + [4])
+    print()
+    print(f"{'file':<{width}}  {'runs':>6}  {'lumis':>7}  {'entries':>9}")
+    print('-'*(width+28))
+    for name,index in indices.items():
+        if index is None:
+            print(f"{name:<{width}}  {'-':>6}  {'-':>7}  {'-':>9}")
+            continue
+        nLumis = sum(len(info["lumis"]) for info in index["runs"].values())
+        print(f"{name:<{width}}  {len(index['runs']):>6}  {nLumis:>7}  {index['clusters'][-1]:>9}")
+    print()
+
+#########################################################################
+
+def parseRunRanges(text):
+    # "315000-316000,317000" -> [[315000, 316000], [317000, 317000]]
+    ranges = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        first,_,last = item.partition("-")
+        ranges.append([int(first), int(last) if last else int(first)])
+    return ranges
+
+#########################################################################
+
+def selectEntriesForRuns(files, indices, runRanges):
+
+    # return (files with some of the selected runs, {name : entry ranges or None}) using the run index of each file
+    # None means that the whole file is read (all its clusters have selected runs, or the file has no index)
+    # the events are still to be filtered by run, since clusters can contain other runs as well
+
+    selected = []
+    entryRanges = {}
+    for name in files:
+        index = indices.get(name)
+        if index is None:
+            selected.append(name)
+            entryRanges[name] = None
+            continue
+        runs = [int(r) for r in index["runs"] if any(first <= int(r) <= last for first,last in runRanges)]
+        ranges = getEntryRangesForRuns(index, runs)
+        if not ranges:
+            continue
+        selected.append(name)
+        entryRanges[name] = None if ranges == [[0, index["clusters"][-1]]] else ranges
+    nEntries = sum(r[1] - r[0] for ranges in entryRanges.values() if ranges for r in ranges)
+    logging.info(f"Run selection: reading {len(selected)}/{len(files)} files, {sum(1 for r in entryRanges.values() if r)} of them partially ({nEntries} entries in the partial ones)")
+    return selected,entryRanges
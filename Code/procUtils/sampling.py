@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import logging
+
+from procUtils.inputFiles import *
+
+#########################################################################
+
+# Fast but representative processing of a fraction of the events: rather than the first files (whose runs are not
+# representative of the whole sample), whole clusters are taken at regular intervals across all clusters of all files,
+# so that every file, and therefore every run, contributes with about the same fraction of its events
+# The choice is deterministic (the same files give the same clusters), and clusters are the units in which the baskets
+# are written, so the skipped ones are not read at all
+# The selected clusters of each file are processed as the clusters of a selection of runs (see fillHistogramsInPool), in a few
+# shards reading from the first to the last selected entry with a filter on the entry number
+# The histograms are then scaled by the inverse of the fraction of entries actually used, and since they have Sumw2
+# the errors are scaled as well, giving the uncertainty on the number of events expected in the whole sample
+
+#########################################################################
+
+def sampleClusters(files, fraction, cache, treename="Events", entryRanges=None):
+
+    # return (files with some selected cluster, {name : list of [start, stop) of the selected clusters}, scale factor)
+    # entryRanges ({name : list of [start, stop) or None}), if given, restricts the clusters to those in the ranges
+    # (e.g. after a selection of runs), files whose clusters cannot be read are skipped
+    # the cluster boundaries are taken from the cache, or read concurrently from the files
+
+    allBoundaries = getCachedFileInfo(files, cache, "clusters", lambda name: getClusterBoundaries(name, treename),
+                                      derived=lambda boundaries: {"entries" : boundaries[-1]})
+    selectedFiles = []
+    selections = {}
+    totalEntries = 0
+    selectedEntries = 0
+    accumulated = 0.5
+    for name in files:
+        boundaries = allBoundaries[name]
+        if boundaries == None:
+            logging.warning(f"Cannot get the clusters of {name}, it will be skipped")
+            continue
+        allowed = entryRanges.get(name) if entryRanges != None else None
+        ranges = []
+        for start,stop in zip(boundaries[:-1], boundaries[1:]):
+            if allowed and not any(first <= start < last for first,last in allowed):
+                continue
+            totalEntries += stop - start
+            accumulated += fraction
+            if accumulated < 1.0:
+                continue
+            accumulated -= 1.0
+            selectedEntries += stop - start
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = stop
+            else:
+                ranges.append([start, stop])
+        if ranges:
+            selectedFiles.append(name)
+            selections[name] = ranges
+    scale = totalEntries / selectedEntries if selectedEntries > 0 else 1.0
+    logging.info(f"Sampling {selectedEntries}/{totalEntries} entries in {len(selections)} files (effective fraction {1./scale:.4f})")
+    return selectedFiles,selections,scale
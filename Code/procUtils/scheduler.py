@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ROOT
+
+from procUtils.rdfEngine import *
+from procUtils.histSpec import *
+from procUtils.inputFiles import *
+from procUtils.ioSettings import *
+
+#########################################################################
+
+# Each shard is a list of files (currently always one file, possibly restricted to an entry range) processed by one worker, which creates its own chain, dataframe and model histograms
+# from the specs (plain dictionaries, so they can be sent to the worker), and sends back the filled histograms
+# Files of other samples (e.g. time-independent MC next to the run-dependent one) can be processed in the same pool,
+# each shard carrying the specs and run axis of its sample: their histograms are returned as "sample/name"
+# The parent sums the partial histograms bin by bin, always in the order of the shards, so that the result does not depend
+# on which worker finished first
+
+#########################################################################
+
+def fillHistogramsOnShard(shard):
+
+    # entryRange is None to process all entries, or [start, stop) (only with one file, and without multithreading)
+    # entrySelection is None, or a list of [start, stop) ranges of the entries to use (within entryRange, if given), applied as
+    # a filter on the entry number (only with one file, and without multithreading so that the entry number of RDataFrame is the one of the tree)
+    files = shard["files"]
+    if shard["entryRange"] != None or shard.get("entrySelection"):
+        if ROOT.ROOT.IsImplicitMTEnabled():
+            ROOT.ROOT.DisableImplicitMT()
+    elif shard["nThreads"] != 1 and not ROOT.ROOT.IsImplicitMTEnabled():
+        ROOT.ROOT.EnableImplicitMT(max(0, shard["nThreads"]))
+    applyStoragePolicy(shard["storage"])
+
+    applyGlobalReadSettings(shard["readSettings"])
+
+    chain = ROOT.TChain(shard["treename"])
+    for n in files:
+        chain.Add(getFileAccessName(n))
+    prefix = f"{shard['sample']}/" if shard.get("sample") else ""
+    histsAndExprs,_ = compileHistogramSpecs(shard["registry"], shard["runAxis"], shard["storage"])
+    branches = getBranchesFromExpressions([extra[0] for extra in histsAndExprs.values()], chain)
+    pruneBranches(chain, branches)
+    configureTreeCache(chain, branches, shard["readSettings"])
+
+    countersBefore = getReadCounters()
+    rdf = ROOT.RDataFrame(chain)
+    if shard["entryRange"] != None:
+        rdf = rdf.Range(*shard["entryRange"])
+    if shard.get("entrySelection"):
+        rdf = applyEntrySelection(rdf, shard["entrySelection"])
+    if shard.get("runSelection"):
+        rdf = applyRunSelection(rdf, chain, shard["runSelection"])
+    booked = bookHistograms(rdf, histsAndExprs, chain)
+    entries = rdf.Count()
+    runEventLoop(booked)
+    return {"histograms" : {prefix + h.GetName() : h for h in histsAndExprs},
+            "entries"    : entries.GetValue(),
+            "readStats"  : getReadCountersDifference(getReadCounters(), countersBefore)}
+
+#########################################################################
+
+def reduceHistograms(total, partial):
+    # bin-wise sum of partial into total, both are {name : histogram}
+    # (partial is the "histograms" item of what fillHistogramsOnShard returns)
+    for name,h in partial.items():
+        if name in total:
+            total[name].Add(h)
+        else:
+            total[name] = h.Clone()
+            total[name].SetDirectory(0)
+
+#########################################################################
+
+def getFileRanges(name, path, nRanges, treename="Events", metadataCache=None):
+    # entry ranges aligned to the clusters in which the file is split, the cluster boundaries are taken from the cache if possible
+    # (name is the original file name, used for the cache, path the one actually read, e.g. a staged copy)
+    if nRanges <= 1:
+        return [None]
+    boundaries = getCachedClusterBoundaries(name, metadataCache, treename, path)
+    if boundaries == None:
+        return [None]
+    return splitClustersIntoRanges(boundaries, nRanges)
+
+#########################################################################
+
+def fillHistogramsInPool(files, registry, runAxis, treename="Events", nJobs=1, nThreads=1, staging=None, readSettings=None,
+                         rangesPerFile=0, metadataCache=None, checkpoint=None, initial=None, snapshot=None, samples=None,
+                         entryRanges=None, runSelection=None, entrySelections=None, storage="double", macros=None):
+
+    # fill the histograms defined in registry processing each file as a separate shard, returns {name : histogram}
+    # and the number of entries processed (after the selections)
+    # with nJobs > 1 the shards are processed by a pool of nJobs processes, each using nThreads threads,
+    # otherwise they are processed one after the other in this process
+    # with a pool, files can also be split into rangesPerFile entry ranges aligned to clusters, each being a separate shard,
+    # so that all processes are used also with few (large) files: if rangesPerFile is 0, files are only split
+    # when there are less files than jobs (ranges are processed single-threaded, RDataFrame::Range does not support multithreading)
+    # if a stagingCache is given, the files are copied locally first and each shard starts as soon as its file is available
+    # the workers are spawned rather than forked, since forking a process where ROOT (or the xrootd client)
+    # already started its threads is not safe
+    # if a checkpointFile is given, it is told about each file as soon as its histograms are summed (after all the files
+    # before it), and a liveSnapshot about each shard summed (see above for how files are split for it), with initial ({name : histogram}, e.g. taken from a previous checkpoint) the sum starts from these histograms
+    # samples ({sample : {"files" : [...], "registry" : ..., "runAxis" : ...}}) are processed in the same pool after files,
+    # and their histograms are returned as "sample/name" (checkpoints and snapshots are meant for a single sample)
+    # entryRanges ({name : list of [start, stop)}, e.g. the clusters with the selected runs) restricts the entries read from
+    # the files in it (if the list is None the whole file is read), and runSelection (list of [first, last] runs) selects the events
+    # of files (not of the other samples): the ranges of a file are split into as many shards as its entry ranges would be
+    # (only one without a pool), each reading from its first to its last entry with a filter on the entry number, so that
+    # the dataframe is not built (and its expressions compiled) again for each range
+    # entrySelections ({name : list of [start, stop)}, e.g. the sampled clusters) selects the entries to use in the files in it,
+    # split into shards as entryRanges (RDataFrame only reads the branches for the entries passing the filter)
+    # storage is the policy for the histograms, see histSpec.py
+    # macros (e.g. ["ccFiles/functions.cc"]) are loaded by each process of the pool, see loadMacros
+    # at the end, a summary of the read calls and bytes read for each file is printed
+
+    sampleOfFile = {f : None for f in files}
+    sampleSpecs = {None : (registry, runAxis)}
+    for sample,info in (samples or {}).items():
+        sampleSpecs[sample] = (info["registry"], info["runAxis"])
+        for f in info["files"]:
+            if f in sampleOfFile:
+                raise RuntimeError(f"Error in fillHistogramsInPool(): file {f} is used in more than one sample")
+            sampleOfFile[f] = sample
+    files = list(sampleOfFile)
+
+    source = staging.prefetch(files) if staging != None else ((f,f) for f in files)
+    if readSettings == None:
+        readSettings = getReadSettings()
+    # live snapshots can only be taken after each shard: unless rangesPerFile is given, the files are then split (also without
+    # a pool) so that each range has about the number of entries between two snapshots
+    liveRanges = snapshot != None and snapshot.everyEvents > 0 and rangesPerFile <= 0
+    if nJobs <= 1:
+        rangesPerFile = max(1, rangesPerFile) if snapshot != None else 1
+    elif rangesPerFile <= 0:
+        rangesPerFile = -(-nJobs // len(files)) if 0 < len(files) < nJobs else 1
+    def getRangesPerFile(name, path):
+        if not liveRanges:
+            return rangesPerFile
+        boundaries = getCachedClusterBoundaries(name, metadataCache, treename, path)
+        return max(rangesPerFile, -(-boundaries[-1] // snapshot.everyEvents)) if boundaries != None else rangesPerFile
+    def getRanges(name, path):
+        # list of (entry range, entry selection) of the shards of a file
+        nRanges = getRangesPerFile(name, path)
+        selection = None
+        if entryRanges != None and entryRanges.get(name) != None:
+            selection = entryRanges[name]
+        elif entrySelections != None and entrySelections.get(name) != None:
+            selection = entrySelections[name]
+        if selection != None:
+            boundaries = getCachedClusterBoundaries(name, metadataCache, treename, path) if nRanges > 1 else None
+            groups = groupEntryRanges(selection, nRanges, boundaries)
+            return [([group[0][0], group[-1][1]], group if len(group) > 1 else None) for group in groups]
+        return [(entryRange, None) for entryRange in getFileRanges(name, path, nRanges, treename, metadataCache)]
+    def makeShard(name, path, entryRange=None, entrySelection=None):
+        return {"files"    : [path],
+                "entryRange" : entryRange,
+                "runSelection" : runSelection if sampleOfFile[name] == None else None,
+                "entrySelection" : entrySelection,
+                "sample"   : sampleOfFile[name],
+                "registry" : sampleSpecs[sampleOfFile[name]][0],
+                "runAxis"  : sampleSpecs[sampleOfFile[name]][1],
+                "treename" : treename,
+                "storage"  : storage,
+                "nThreads" : nThreads if entryRange == None and entrySelection == None else 1,
+                "readSettings" : readSettings}
+    def isSelected(name):
+        # whether only some of the entries of the file are processed
+        return ((entryRanges != None and entryRanges.get(name) != None) or (entrySelections != None and entrySelections.get(name) != None)
+                or (runSelection != None and sampleOfFile[name] == None))
+    def storeEntries(name, entries):
+        # the number of entries of the files processed whole is kept in the metadata cache for later jobs,
+        # as counted by the event loops, so that the files are not opened again to count them
+        if metadataCache != None and not isSelected(name):
+            stat = getFileStat(name)
+            if stat is not None:
+                metadataCache.update(name, stat, entries=entries)
+    def addReadStats(name, stats):
+        if name in readStats:
+            stats = {key : readStats[name][key] + stats[key] for key in stats}
+        readStats[name] = stats
+
+    total = {}
+    nEntries = 0
+    if initial:
+        reduceHistograms(total, initial)
+    readStats = {}
+    if nJobs <= 1:
+        for ishard,(name,path) in enumerate(source):
+            logging.info(f"Processing shard {ishard+1}/{len(files)}: {name}")
+            entriesOfFile = 0
+            for entryRange,entrySelection in getRanges(name, path):
+                result = fillHistogramsOnShard(makeShard(name, path, entryRange, entrySelection))
+                reduceHistograms(total, result["histograms"])
+                entriesOfFile += result["entries"]
+                if snapshot != None:
+                    snapshot.update(total, result["entries"])
+                addReadStats(name, result["readStats"])
+            nEntries += entriesOfFile
+            storeEntries(name, entriesOfFile)
+            if staging != None:
+                staging.release(name)
+            if checkpoint != None:
+                checkpoint.fileDone(total, name)
+    else:
+        logging.info(f"Processing {len(files)} files with {nJobs} parallel jobs" + (f", splitting each file in up to {rangesPerFile} ranges" if rangesPerFile > 1 else ""))
+        # partial results are merged in the order of the input files (and of the ranges within a file),
+        # keeping those which finished early until their turn
+        # (bin contents are integer counts, so the order does not matter for them, but this makes the merging reproducible)
+        fileIndex = {f : i for i,f in enumerate(files)}
+        partials = {}
+        futures = {}
+        nRangesOfFile = {}
+        pendingOfFile = {}
+        entriesOfFile = {}
+        nextToMerge = [0, 0]
+        def collect(future):
+            nonlocal nEntries
+            shardKey,name = futures.pop(future)
+            result = future.result()
+            partials[shardKey] = result
+            addReadStats(name, result["readStats"])
+            while tuple(nextToMerge) in partials:
+                logging.debug(f"Merging shard {nextToMerge[1]+1} of file {nextToMerge[0]+1}/{len(files)}")
+                merged = partials.pop(tuple(nextToMerge))
+                reduceHistograms(total, merged["histograms"])
+                nEntries += merged["entries"]
+                entriesOfFile[nextToMerge[0]] = entriesOfFile.get(nextToMerge[0], 0) + merged["entries"]
+                if snapshot != None:
+                    snapshot.update(total, merged["entries"])
+                nextToMerge[1] += 1
+                if nextToMerge[1] == nRangesOfFile[nextToMerge[0]]:
+                    storeEntries(files[nextToMerge[0]], entriesOfFile.pop(nextToMerge[0], 0))
+                    if checkpoint != None:
+                        checkpoint.fileDone(total, files[nextToMerge[0]])
+                    nextToMerge[0] += 1
+                    nextToMerge[1] = 0
+
+        # staged files are released as soon as all their shards are done, from the thread of the pool which is told about it,
+        # since the staging cache may be waiting for releases before starting other copies (while this thread waits for the next file)
+        releaseLock = threading.Lock()
+        def shardDone(name):
+            with releaseLock:
+                pendingOfFile[name] -= 1
+                done = pendingOfFile[name] == 0
+            if done and staging != None:
+                staging.release(name)
+
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=nJobs, mp_context=context, initializer=loadMacros, initargs=(macros or [],)) as pool:
+            for name,path in source:
+                ranges = getRanges(name, path)
+                nRangesOfFile[fileIndex[name]] = len(ranges)
+                pendingOfFile[name] = len(ranges)
+                for irange,(entryRange,entrySelection) in enumerate(ranges):
+                    future = pool.submit(fillHistogramsOnShard, makeShard(name, path, entryRange, entrySelection))
+                    futures[future] = ((fileIndex[name], irange), name)
+                    future.add_done_callback(lambda f, name=name: shardDone(name))
+                # merge what is already done while waiting for the next file, so that partial results do not pile up
+                for future in [f for f in futures if f.done()]:
+                    collect(future)
+            while futures:
+                collect(next(as_completed(futures)))
+
+    printReadSummary({f : readStats[f] for f in files if f in readStats})
+    for h in total.values():
+        resetStatsKeepingEntries(h)
+    return total, nEntries
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import os, os.path
+import json
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from procUtils.inputFiles import *
+
+#########################################################################
+
+# Input files on /store or /eos are copied into a local cache directory before being processed, since reading local files
+# is much faster. The copies are made by a transport object, which must implement
+#   isRemote(name)    : whether the file has to be staged at all (local files are processed in place)
+#   fetch(name, dest) : copy the file to the local path dest
+# xrootdTransport is the one used in production, localTransport reads from a local directory mirroring the /store tree,
+# and can be used to test the staging without a grid certificate
+
+#########################################################################
+
+class xrootdTransport:
+
+    def isRemote(self, name):
+        return getFileAccessName(name).startswith("root://")
+
+    def fetch(self, name, dest):
+        cmd = ["xrdcp", "--force", "--silent", getFileAccessName(name), dest]
+        logging.debug(" ".join(cmd))
+        subprocess.run(cmd, check=True)
+
+#########################################################################
+
+class localTransport:
+
+    def __init__(self, sourceDir):
+        self.sourceDir = sourceDir
+
+    def isRemote(self, name):
+        return os.path.isfile(os.path.join(self.sourceDir, name.lstrip("/")))
+
+    def fetch(self, name, dest):
+        shutil.copyfile(os.path.join(self.sourceDir, name.lstrip("/")), dest)
+
+#########################################################################
+
+class stagingCache:
+
+    # files are stored in cacheDir with the same path as the original name, and tracked in an index (kept in cacheDir as well)
+    # with their size and last usage time: when the cache exceeds maxBytes, the least recently used files are removed,
+    # except those currently in use (staged but not yet released by the consumer)
+    # files in use cannot be removed, so no new copy is started while they already take maxBytes (see prefetch): the cache
+    # can then exceed maxBytes at most by the copies already running
+
+    indexName = "stagingIndex.json"
+
+    def __init__(self, cacheDir, maxBytes, transport=None, nTransfers=4):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.transport = transport if transport != None else xrootdTransport()
+        self.nTransfers = max(1, nTransfers)
+        self.lock = threading.Lock()
+        self.inUse = set()
+        self.released = threading.Condition(self.lock)
+        os.makedirs(cacheDir, exist_ok=True)
+        self.index = {}
+        indexPath = os.path.join(cacheDir, self.indexName)
+        if os.path.isfile(indexPath):
+            with open(indexPath) as f:
+                self.index = json.load(f)
+        # forget files that were removed by hand
+        self.index = {n : info for n,info in self.index.items() if os.path.isfile(self.getLocalPath(n))}
+
+    def getLocalPath(self, name):
+        return os.path.join(self.cacheDir, name.lstrip("/"))
+
+    def saveIndex(self):
+        # called with the lock held
+        tmp = os.path.join(self.cacheDir, self.indexName + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp, os.path.join(self.cacheDir, self.indexName))
+
+    def evict(self):
+        # called with the lock held
+        totalBytes = sum(info["size"] for info in self.index.values())
+        for name in sorted(self.index, key=lambda n: self.index[n]["lastUsed"]):
+            if totalBytes <= self.maxBytes:
+                break
+            if name in self.inUse:
+                continue
+            logging.debug(f"Removing {name} from staging cache")
+            totalBytes -= self.index[name]["size"]
+            os.remove(self.getLocalPath(name))
+            del self.index[name]
+        if totalBytes > self.maxBytes:
+            logging.warning(f"Staging cache holds {totalBytes/1e9:.1f} GB of files in use, above the limit of {self.maxBytes/1e9:.1f} GB")
+
+    def stage(self, name):
+        # copy one file in the cache (unless already there), return its local path
+        local = self.getLocalPath(name)
+        with self.lock:
+            self.inUse.add(name)
+            cached = name in self.index
+        if not cached:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            tmp = local + ".part"
+            start = time.time()
+            try:
+                self.transport.fetch(name, tmp)
+            except Exception:
+                # do not leave partial copies around, they are not in the index and would never be removed
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            os.replace(tmp, local)
+            size = os.path.getsize(local)
+            logging.info(f"Staged {name} ({size/1e6:.0f} MB in {time.time()-start:.1f} s)")
+        with self.lock:
+            self.index[name] = {"size" : os.path.getsize(local), "lastUsed" : time.time()}
+            self.evict()
+            self.saveIndex()
+        return local
+
+    def release(self, name):
+        # the consumer is done with the file, which can now be evicted
+        with self.lock:
+            self.inUse.discard(name)
+            self.released.notify_all()
+
+    def getInUseBytes(self):
+        # called with the lock held
+        return sum(self.index[n]["size"] for n in self.inUse if n in self.index)
+
+    def waitForSpace(self, block=True):
+        # whether a new copy can start, waiting for the consumer to release files if block is True
+        # (a copy can always start when no file is in use, so that a single file larger than maxBytes is still processed)
+        with self.lock:
+            if self.inUse and self.getInUseBytes() >= self.maxBytes:
+                if not block:
+                    return False
+                logging.info(f"Staging cache full of files in use ({self.getInUseBytes()/1e9:.1f} GB), waiting for them to be released")
+                while self.inUse and self.getInUseBytes() >= self.maxBytes:
+                    self.released.wait()
+            return True
+
+    def prefetch(self, files):
+
+        # generator yielding (name, path to use) as soon as each file is available, with at most nTransfers copies running
+        # local files are yielded as they are, and if a copy fails the file is read remotely
+        # the consumer should call release(name) when done with a file: while the files in use take maxBytes or more,
+        # no other copy is started, and when no copy is running the generator waits for the release (so with a consumer
+        # which keeps files in use after asking for the next one, release must be called from another thread)
+
+        pending = {}
+        queue = list(files)
+        with ThreadPoolExecutor(max_workers=self.nTransfers) as pool:
+            while queue or pending:
+                while queue and len(pending) < self.nTransfers:
+                    name = queue[0]
+                    if not self.transport.isRemote(name):
+                        queue.pop(0)
+                        yield name,name
+                        continue
+                    if not self.waitForSpace(block=not pending):
+                        break
+                    queue.pop(0)
+                    pending[pool.submit(self.stage, name)] = name
+                if not pending:
+                    continue
+                done,_ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    try:
+                        path = future.result()
+                    except Exception as e:
+                        logging.error(f"Staging of {name} failed ({e}), it will be read remotely")
+                        self.release(name)
+                        path = getFileAccessName(name)
+                    yield name,path
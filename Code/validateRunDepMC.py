@@ -4,6 +4,7 @@ import re
 import os, os.path
 import logging
 import argparse
+import json
 import shutil
 
 from os import listdir
@@ -19,15 +20,27 @@ ROOT.gROOT.SetBatch(True)
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from plotUtils.utility import *
-
-ROOT.gInterpreter.ProcessLine(".O3")
-ROOT.ROOT.EnableImplicitMT()
+from plotUtils.renderPlots import *
+from procUtils.rdfEngine import *
+from procUtils.histSpec import *
+from procUtils.histCache import *
+from procUtils.inputFiles import *
+from procUtils.scheduler import *
+from procUtils.staging import *
+from procUtils.ioSettings import *
+from procUtils.columnarEngine import *
+from procUtils.checkpoint import *
+from procUtils.liveSnapshot import *
+from procUtils.runAxis import *
+from procUtils.runIndex import *
+from procUtils.sampling import *
 
 #ROOT.gSystem.Load("libFWCoreFWLite")
 #ROOT.FWLiteEnabler.enable()
 #ROOT.gSystem.Load("libDataFormatsFWLite")
 #ROOT.gSystem.Load("libDataFormatsPatCandidates")
-ROOT.gROOT.ProcessLine(f".L {os.environ['HOME']}/rootlogon.C")
+rootlogon = f"{os.environ['HOME']}/rootlogon.C"
+ROOT.gROOT.ProcessLine(f".L {rootlogon}")
 
 #/cvmfs/cms.cern.ch/slc7_amd64_gcc900/cms/cmssw/CMSSW_11_3_0_pre3/src
 #ROOT.gInterpreter.Declare('#include "DataFormats/EcalRecHit/interface/EcalRecHit.h"')
@@ -38,85 +51,237 @@ def setLogging(verbosity):
     verboseLevel = [logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
     logging.basicConfig(format='%(levelname)s: %(message)s', level=verboseLevel[min(4,verbosity)])
     
-def compileMacro(x,basedir=os.environ['PWD']):
-    #ROOT.gROOT.ProcessLine(".L %s/%s+" % (os.environ['CMSSW_BASE'],x));
-    success = ROOT.gSystem.CompileMacro("%s" % (x),"k")
-    if not success:
-        logging.error("Loading and compiling %s failed! Exit" % x)
-        quit()
+def plotLiveSnapshot(histograms, names, outdir):
+
+    # quick plots of some key histograms from the partial sums, while the job is running
+    # (only the histograms themselves, projections are made at the end when the IOVs are known)
+
+    for name in names:
+        if name not in histograms or histograms[name].Integral() == 0.0:
+            continue
+        h = histograms[name].Clone(name)
+        h.SetDirectory(0)
+        if h.GetDimension() == 1:
+            drawHistogram1D(h, ["skipStatBox"], outdir)
+        elif h.GetDimension() == 2:
+            drawHistogramVsRun(h, [], [], outdir)
+
+def getInputFiles(inputdir, nMaxFiles=0):
+    # a txt file with the list of files, or a directory with the root files
+    files = []
+    if isfile(inputdir):
+        with open(inputdir) as f:
+            for line in f:
+              files.append(line.strip())  
+    else:   
+        files = [join(inputdir, f) for f in listdir(inputdir) if isfile(join(inputdir, f)) and f.endswith(".root")]
+    if nMaxFiles > 0:
+        files = files[:nMaxFiles]
+    return files
+
+def writeHistograms(histsAndExprs, registry, outdir, directory=""):
 
-if "/functions_cc.so" not in ROOT.gSystem.GetLibraries():
-   compileMacro("ccFiles/functions.cc")
+    # write the histograms in the current directory of the output file, together with the projections for each IOV
+    # and the views of the threshold scans, and return the render jobs for their plots (see plotUtils/renderPlots.py)
+    # directory is the path of the current directory in the file, used to refer to the histograms in the jobs
+
+    runBins = []
+    jobs = []
+
+    def addJob(kind, h, opts, projections=[]):
+        jobs.append({"kind"        : kind,
+                     "name"        : directory + h.GetName(),
+                     "projections" : [directory + p.GetName() for p in projections],
+                     "options"     : opts,
+                     "outdir"      : outdir})
+
+    for h,extra in histsAndExprs.items():
+
+        opts = extra[1:] if len(extra) > 1 else []
+        logging.info(f"Processing {h.GetName()}")
+
+        if h.Integral() == 0.0:
+            logging.warning(f"{h.GetName()} has no entries, please check! It will be skipped")
+            if h.GetDimension() == 1 and h.Integral(0, 1+h.GetNbinsX()) > 0.0:
+                logging.warning(f"There seems to be events in the under/overflow bins, though, so check the range")
+            continue
+        
+        if h.GetName() == "runNumber":
+            for i in range(1, 1+h.GetNbinsX()):
+                if h.GetBinContent(i) > 0:
+                    runBins.append(i)
+                    
+        if h.GetDimension() == 1:
+
+            h.Write()
+            addJob("TH1", h, opts)
+            
+        elif h.GetDimension() == 2:
+
+            h.Write()
+            projections = [] if "noIOVprojection" in opts else getIOVProjections(h, runBins)
+            for hist in projections:
+                hist.Write()
+            addJob("vsRun", h, opts, projections)
+            
+        elif h.GetDimension() == 3:
+
+            # threshold scan: number of objects above threshold (y) versus run (x) for each threshold (z)
+            # the views for the requested thresholds are obtained by projecting a single bin of the threshold axis
+            h.Write()
+            zaxis = h.GetZaxis()
+            for thr in registry[h.GetName()]["thresholdViews"]:
+                zbin = max(1, min(zaxis.GetNbins(), zaxis.FindFixBin(thr)))
+                thrLow = zaxis.GetBinLowEdge(zbin)
+                thrView = getTH2fromTH3(h, f"{h.GetName()}_thr{getThresholdLabel(thrLow)}", binStart=zbin, proj="yxe")
+                thrView.SetDirectory(0)
+                thrView.GetYaxis().SetTitle(f"{h.GetYaxis().GetTitle()} ({zaxis.GetTitle()} = {thrLow:g})")
+                thrView.GetZaxis().SetTitle("Events")
+                thrView.Write()
+                projections = [] if "noIOVprojection" in opts else getIOVProjections(thrView, runBins)
+                for hist in projections:
+                    hist.Write()
+                addJob("vsRun", thrView, opts, projections)
+            zaxis.SetRange()
+
+    return jobs
+
+# C++ functions used in the expressions, only compiled when the events are processed with RDataFrame (see loadMacros)
+rdfMacros = ["ccFiles/functions.cc"]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("inputdir",  type=str, nargs=1)
+    parser.add_argument("inputdir",  type=str, nargs="?", help = "Directory with the input files, or txt file with their list (not needed with --plot-only or --export-deferred)")
     parser.add_argument("outdir",    type=str, nargs=1)
     parser.add_argument("-n", "--n-files", dest="nMaxFiles", type=int, default=0, help = "If positive, select how many files to use (default is to use all)")
     parser.add_argument("-v", "--verbose", type=int, default=3, choices=[0,1,2,3,4], help="Set verbosity level with logging, the larger the more verbose")
     parser.add_argument(      "--time-indep", dest="timeIndependent", action="store_true", help = "Run on time independent MC (one run, and possibly other differences)")
+    parser.add_argument(      "--time-indep-input", dest="timeIndependentInput", type=str, default="", help = "Also process this time-independent MC sample (txt file with the list of files, or directory) in the same job, its histograms are saved in the timeIndep directory of the output file and its plots in outdir/timeIndep/")
+    parser.add_argument(      "--exact-run-axis", dest="exactRunAxis", action="store_true", help = "Read the runs in the input files beforehand (only EventAuxiliary, cached in --metadata-cache) and make the run axis with one bin for each run")
+    parser.add_argument(      "--build-run-index", dest="buildRunIndex", action="store_true", help = "Index the runs, lumisections and entries of each input file (reading only EventAuxiliary) and save it in --metadata-cache, so that later selections of runs can skip files and clusters. Files already indexed are indexed again")
+    runSelection = parser.add_mutually_exclusive_group()
+    runSelection.add_argument(      "--runs", type=str, default="", help = "Only process the events of these runs, given as comma separated runs or ranges of runs (e.g. 315000-316000,317000). The run index of the files (see --build-run-index, built when missing) is used to only read the files and clusters containing them")
+    runSelection.add_argument(      "--iov", type=int, default=0, help = "As --runs, selecting the runs of this IOV (non empty bin of the run axis, counting from 1)")
+    parser.add_argument(      "--sample-fraction", dest="sampleFraction", type=float, default=0.0, help = "If between 0 and 1, only process this fraction of the events, taking whole clusters at regular intervals across all files, and scale the histograms accordingly (for a quick but representative look)")
+    parser.add_argument(      "--storage", type=str, default="double", choices=storagePolicies, help = "Storage of the histograms: double (TH*D with sum of squared weights), nosumw2 (TH*D, errors from the contents, fine for unweighted fills) or float (TH*F without sum of squared weights), to reduce the memory used")
+    parser.add_argument(      "--memory-report", dest="memoryReport", action="store_true", help = "Print the memory used by each histogram")
+    parser.add_argument(      "--plot-jobs", dest="nPlotJobs", type=int, default=0, help = "Number of parallel processes making the plots, reading the histograms from the output file (if 0, the same as --jobs)")
+    parser.add_argument(      "--plot-only", dest="plotOnly", action="store_true", help = "Only remake the plots from the histograms in outdir/allHistograms.root (with the plotting options from --spec), without reading the input files (inputdir is not needed)")
+    parser.add_argument(      "--force-plots", dest="forcePlots", action="store_true", help = "Save all plots again, also those whose histograms and plotting options did not change since they were last made")
+    parser.add_argument(      "--plot-formats", dest="plotFormats", type=str, default="png,pdf", help = "Comma separated list of the formats of the plots")
+    parser.add_argument(      "--defer-pdf", dest="deferPdf", action="store_true", help = "Do not save the plots as pdf now, but queue them in outdir/deferredExport.json, to be made later with --export-deferred")
+    parser.add_argument(      "--export-deferred", dest="exportDeferred", action="store_true", help = "Only make the plots queued by --defer-pdf, from the histograms in outdir/allHistograms.root, without reading the input files (inputdir is not needed)")
+    parser.add_argument(      "--spec", dest="specFile", type=str, default="histSpecs/runDepValidation.json", help = "File (json or yaml) with the definition of the histograms to make")
+    parser.add_argument(      "--no-cache", dest="noCache", action="store_true", help = "Do not reuse histograms from an existing allHistograms.root in outdir, fill all of them again")
+    parser.add_argument("-t", "--threads", dest="nThreads", type=int, default=0, help = "Number of threads for the RDataFrame event loop (0 means use all available cores, or 1 per job with --jobs)")
+    parser.add_argument("-j", "--jobs", dest="nJobs", type=int, default=1, help = "If larger than 1, process the input files with a pool of this many processes, and merge the histograms at the end")
+    parser.add_argument(      "--stage-dir", dest="stageDir", type=str, default="", help = "If given, copy remote input files in this local directory before processing them (files already there are reused)")
+    parser.add_argument(      "--stage-size", dest="stageSize", type=float, default=50.0, help = "Maximum size in GB of the staging directory, the least recently used files are removed when it is exceeded")
+    parser.add_argument(      "--stage-transfers", dest="stageTransfers", type=int, default=4, help = "Number of files copied concurrently in the staging directory")
+    parser.add_argument(      "--stage-from", dest="stageFrom", type=str, default="", help = "Copy files from this local directory mirroring the /store tree, instead of using xrootd (mainly for tests)")
+    parser.add_argument(      "--metadata-cache", dest="metadataCache", type=str, default=os.path.expanduser("~/.cache/validateRunDepMC/fileMetadata.json"), help = "Json file where information about the input files (e.g. number of entries) is cached")
+    parser.add_argument(      "--cache-size", dest="cacheSize", type=float, default=100.0, help = "Size in MB of the TTreeCache used to read the input files (0 to disable it)")
+    parser.add_argument(      "--cache-learn-entries", dest="cacheLearnEntries", type=int, default=0, help = "Entries used by the TTreeCache to learn the branches to read. If 0, the branches needed by the histograms are added to the cache explicitly")
+    parser.add_argument(      "--async-prefetch", dest="asyncPrefetch", action="store_true", help = "Prefetch the baskets in a separate thread")
+    parser.add_argument(      "--read-summary", dest="readSummary", action="store_true", help = "Process the files one by one, so to print a summary of read calls and bytes read for each file (always done with --jobs or --stage-dir)")
+    parser.add_argument(      "--engine", type=str, default="rdf", choices=["rdf", "columnar"], help = "Engine used to fill the histograms: RDataFrame, or columnar reading with uproot/awkward/boost_histogram (no C++ compilation nor CMSSW dictionaries needed)")
+    parser.add_argument(      "--step-size", dest="stepSize", type=str, default="100 MB", help = "Size of the batches read by the columnar engine (number of entries or memory size, like \"100 MB\")")
+    parser.add_argument(      "--ranges-per-file", dest="rangesPerFile", type=int, default=0, help = "With --jobs (or live snapshots), split each file in this many entry ranges (aligned to the tree clusters) processed as separate tasks. If 0, files are split only when they are less than the jobs, or in ranges of --live-events entries")
+    parser.add_argument(      "--checkpoint-every", dest="checkpointEvery", type=int, default=0, help = "If positive, save the partial histograms in outdir every this many processed files (files are then processed one by one, as with --read-summary)")
+    parser.add_argument(      "--resume", action="store_true", help = "Resume from the checkpoint in outdir, processing only the files not yet done (checkpoints are also written, every 10 files unless --checkpoint-every is given)")
+    parser.add_argument(      "--live-events", dest="liveEvents", type=int, default=0, help = "If positive, save the partial histograms in outdir/live/ every this many processed events, and remake the plots in --live-plots (files are then processed one by one, as with --read-summary)")
+    parser.add_argument(      "--live-seconds", dest="liveSeconds", type=float, default=0.0, help = "As --live-events, but every this many seconds")
+    parser.add_argument(      "--live-plots", dest="livePlots", type=str, default="runNumber,numberEBrechit_run", help = "Comma separated list of the histograms plotted from the live snapshots")
     args = parser.parse_args()
 
+    # with multiple jobs the threads are only started in the workers
+    if args.nJobs > 1:
+        if args.nThreads == 0:
+            args.nThreads = 1
+    elif args.nThreads != 1:
+        ROOT.ROOT.EnableImplicitMT(max(0, args.nThreads))
+
     print("\n\n")
-    ROOT.TH1.SetDefaultSumw2()
+    applyStoragePolicy(args.storage)
     treename = "Events"
 
     setLogging(args.verbose)
+    setSkipUnchangedPlots(not args.forcePlots)
+    # with --defer-pdf, the pdf are only made on demand from the histograms saved in the output file
+    plotFormats = [x for x in args.plotFormats.split(",") if x]
+    if not plotFormats:
+        parser.error("--plot-formats needs at least one format")
+    if args.inputdir == None and not args.plotOnly and not args.exportDeferred:
+        parser.error("the inputdir argument is required to process the input files")
+    deferredFormats = ["pdf"] if args.deferPdf and "pdf" in plotFormats else []
+    plotFormats = [x for x in plotFormats if x not in deferredFormats]
+    setPlotFormats(plotFormats)
     
     outdir = args.outdir[0]
     if not outdir.endswith('/'):
         outdir += '/'
     createPlotDirAndCopyPhp(outdir)
+    exportQueue = outdir + "deferredExport.json"
+    if args.exportDeferred:
+        getCanvases()
+        adjustSettings_CMS_lumi()
+        runDeferredExport(exportQueue, nJobs=args.nPlotJobs if args.nPlotJobs > 0 else args.nJobs, rootlogon=rootlogon, skipUnchanged=not args.forcePlots)
+        quit()
 
-    files = []
-    if isfile(args.inputdir[0]):
-        with open(args.inputdir[0]) as f:
-            for line in f:
-              files.append(line.strip())  
-    else:   
-        files = [join(args.inputdir[0], f) for f in listdir(args.inputdir[0]) if isfile(join(args.inputdir[0], f)) and f.endswith(".root")]
+    # plots are remade from the histograms saved by a previous job, including the projections for each IOV,
+    # so that the plotting style can be changed without processing the events again
+    if args.plotOnly:
+        foutname = outdir + "allHistograms.root"
+        if not os.path.isfile(foutname):
+            logging.error(f"{foutname} not found, it is needed with --plot-only. Exit")
+            quit()
+        plotOptions = {name : getPlotOptions(spec) for name,spec in loadHistogramSpecs(args.specFile).items()}
+        getCanvases()
+        adjustSettings_CMS_lumi()
+        renderJobs = getRenderJobsFromFile(foutname, plotOptions, outdir)
+        timeIndepJobs = getRenderJobsFromFile(foutname, plotOptions, outdir + "timeIndep/", directory="timeIndep/")
+        if timeIndepJobs:
+            createPlotDirAndCopyPhp(outdir + "timeIndep/")
+        renderPlots(foutname, renderJobs + timeIndepJobs, nJobs=args.nPlotJobs if args.nPlotJobs > 0 else args.nJobs, rootlogon=rootlogon, skipUnchanged=not args.forcePlots, formats=plotFormats)
+        if deferredFormats:
+            queueDeferredExport(exportQueue, foutname, renderJobs + timeIndepJobs, deferredFormats)
+        quit()
 
-    #print(files)
-    #quit()
-        
-    if args.nMaxFiles > 0:
-        files = files[:args.nMaxFiles]
+    if args.engine == "rdf":
+        try:
+            loadMacros(rdfMacros)
+        except RuntimeError as e:
+            logging.error(f"{e}. Exit")
+            quit()
+
+    files = getInputFiles(args.inputdir, args.nMaxFiles)
     logging.debug(len(files))
     #for f in files:
     #    print(f)
 
+    readSettings = getReadSettings(args.cacheSize, args.cacheLearnEntries, args.asyncPrefetch)
+    applyGlobalReadSettings(readSettings)
     chain = ROOT.TChain(treename)
     
     logging.debug('='*30)
     logging.debug("Printing files to process")
     logging.debug('-'*30)
     for n in files:
-        if n.startswith("/store/"):
-            name = f"root://xrootd-cms.infn.it//{n}"
-        elif n.startswith("/eos/cms/"):
-            name = n.replace('/eos/cms/','root://eoscms.cern.ch//')
-        else:
-            name = n
+        name = getFileAccessName(n)
         logging.debug(name)
         chain.Add(name)
     logging.debug('='*30)
 
-    print(f"Chain formed: there are {chain.GetEntries()} entries to process")
-    print("\n\n")
-
-    lok  = chain.GetListOfLeaves()
-    chain.SetBranchStatus("*",0)
-    #print("Using these branches")
-    for b in lok:
-         name = b.GetName()
-         if name.startswith("recoMuon"):
-             continue
-         #if not name.startswith("Ecal") and "EventAuxiliary" not in name and not re.match("^E(B|E)DigiCollection.*",name):
-         #    continue
-         #EcalRecHitsSorted_reducedEcalRecHitsEE__RECO.obj
-         #print(f"{name}")
-         chain.SetBranchStatus(name,1)
+    # do not call chain.GetEntries() here, it would open all files before starting
+    print(f"Chain formed: there are {len(files)} files to process")
     print("\n\n")
+    metadataCache = fileMetadataCache(args.metadataCache)
+    # the run index is built first when needed, so that the runs of the files (e.g. for --iov or the exact run axis) are taken from it
+    indices = None
+    if args.buildRunIndex or args.runs or args.iov > 0:
+        indices = getRunIndex(files, metadataCache, treename, rebuild=args.buildRunIndex)
+        if args.buildRunIndex:
+            printRunIndexSummary(indices)
 
     nRunBins = 120
     runLow = 314000
@@ -126,192 +291,193 @@ if __name__ == "__main__":
         nRunBins = 1
         runLow = 0.0
         runHigh = 10.0
-        
-    
-    model_runNumber = ROOT.TH1D("runNumber","run number", nRunBins, runLow, runHigh)
-
-    # doesn't work as expected when filling histograms
-    #model_EBreducedRechit = ROOT.TH3D("EBreducedRechit", ";run number;number of reduced EB RecHits;energy of reduced EB RecHits (GeV)", 
-    #                                  nRunBins, runLow, runHigh, 50, 0, 1000, 60, 0, 15)
-
-    model_energyPFRechit_run = ROOT.TH2D("energyPFRechit_run", ";run number;energy of PFRecHits (GeV);Events", 
-                                         nRunBins, runLow, runHigh, 60, 0, 15)
-    
-
-    model_numberEBreducedRechit_run = ROOT.TH2D("numberEBreducedRechit_run", ";run number;number of reduced EB RecHits;Events", 
-                                                nRunBins, runLow, runHigh, 50, 0, 1000)
-    model_numberEEreducedRechit_run = ROOT.TH2D("numberEEreducedRechit_run", ";run number;number of reduced EE RecHits;Events", 
-                                                nRunBins, runLow, runHigh, 50, 0, 1000)
-    model_energyEBreducedRechit_run = ROOT.TH2D("energyEBreducedRechit_run", ";run number;energy of reduced EB RecHits (GeV);Events", 
-                                                nRunBins, runLow, runHigh, 60, 0, 15)
-    model_energyEEreducedRechit_run = ROOT.TH2D("energyEEreducedRechit_run", ";run number;energy of reduced EE RecHits (GeV);Events", 
-                                                nRunBins, runLow, runHigh, 60, 0, 15)
-    model_numberEBrechit_run = ROOT.TH2D("numberEBrechit_run", ";run number;number of EB RecHits;Events", 
-                                         nRunBins, runLow, runHigh, 100, 500, 2500)
-    model_numberEErechit_run = ROOT.TH2D("numberEErechit_run", ";run number;number of EE RecHits;Events", 
-                                         nRunBins, runLow, runHigh, 75, 0, 1500)
-    model_energyEBrechit_run = ROOT.TH2D("energyEBrechit_run", ";run number;energy of EB RecHits (GeV);Events", 
-                                         nRunBins, runLow, runHigh, 60, 0, 15)
-    model_energyEErechit_run = ROOT.TH2D("energyEErechit_run", ";run number;energy of EE RecHits (GeV);Events", 
-                                         nRunBins, runLow, runHigh, 60, 0, 15)
-
-
-    model_numberBasicClusterEB_run = ROOT.TH2D("numberBasicClusterEB__run", ";run number;number of EB basic clusters;Events", 
-                                               nRunBins, runLow, runHigh, 50, 0, 50)
-    model_etaBasicClusterEB_run = ROOT.TH2D("etaBasicClusterEB__run", ";run number;#eta of EB basic clusters;Events", 
-                                            nRunBins, runLow, runHigh, 40, -1.5, 2.5)
-    model_energyBasicClusterEB_run = ROOT.TH2D("energyBasicClusterEB__run", ";run number;energy of EB basic clusters (GeV);Events", 
-                                               nRunBins, runLow, runHigh, 100, 0, 100)
-
-
-    model_numberBasicClusterEE_run = ROOT.TH2D("numberBasicClusterEE__run", ";run number;number of EE basic clusters;Events", 
-                                               nRunBins, runLow, runHigh, 50, 0, 50)
-    model_etaBasicClusterEE_run = ROOT.TH2D("etaBasicClusterEE__run", ";run number;#eta of EE basic clusters;Events", 
-                                            nRunBins, runLow, runHigh, 70, -3.0, 4.0)
-    model_energyBasicClusterEE_run = ROOT.TH2D("energyBasicClusterEE__run", ";run number;energy of EE basic clusters (GeV);Events", 
-                                               nRunBins, runLow, runHigh, 100, 0, 100)
+    runAxis = [nRunBins, runLow, runHigh]
+    # the run axis can also be made with exactly one bin for each run found in the input files
+    if args.exactRunAxis:
+        runAxis = getExactRunAxis(files, metadataCache, treename) or runAxis
+
+    # only the files and clusters with the selected runs are read, and the events are then filtered by run
+    runRanges = None
+    entryRanges = None
+    if args.runs or args.iov > 0:
+        if args.runs:
+            runRanges = parseRunRanges(args.runs)
+        else:
+            runRanges = [[r,r] for r in getRunsOfIOV(getRunsFromIndex(indices), runAxis, args.iov)]
+        files,entryRanges = selectEntriesForRuns(files, indices, runRanges)
+        if not files:
+            logging.error(f"None of the input files contains the selected runs {runRanges}. Exit")
+            quit()
+        print(f"Selected runs {runRanges}: {len(files)} files to process")
+
+    # a fraction of the clusters, spread across all files (and within the selected runs, if any)
+    sampling = 0.0 < args.sampleFraction < 1.0
+    entrySelections = None
+    sampleScale = 1.0
+    if sampling:
+        files,entrySelections,sampleScale = sampleClusters(files, args.sampleFraction, metadataCache, treename, entryRanges)
+        entryRanges = None
+        if not files:
+            logging.error("No clusters could be sampled from the input files. Exit")
+            quit()
+        print(f"Sampling a fraction {args.sampleFraction} of the events: {len(files)} files to process")
     
-    # model_numberEBdigi_run = ROOT.TH2D("numberEBdigi_run", ";run number;number of EB Digi;Events", 
-    #                                      nRunBins, runLow, runHigh, 50, 0, 200)
-    # model_numberEEdigi_run = ROOT.TH2D("numberEEdigi_run", ";run number;number of EE Digi;Events", 
-    #                                      nRunBins, runLow, runHigh, 50, 0, 200)
-
-    histsAndExprs = {model_runNumber      : ["EventAuxiliary.run()", "skipStatBox"],
-
-                     #model_EBreducedRechit : ["EcalRecHitsSorted_reducedEcalRecHitsEB__RECO.obj.obj.energy():EcalRecHitsSorted_reducedEcalRecHitsEB__RECO.obj.size():EventAuxiliary.run()","logz"]
-
-                     model_energyPFRechit_run : ["recoPFRecHits_particleFlowRecHitECAL_Cleaned_RECO.obj.energy():EventAuxiliary.run()", "logz"],
-                     
-                     model_numberEBreducedRechit_run : ["EcalRecHitsSorted_reducedEcalRecHitsEB__RECO.obj.size():EventAuxiliary.run()"],
-                     model_numberEEreducedRechit_run : ["EcalRecHitsSorted_reducedEcalRecHitsEE__RECO.obj.size():EventAuxiliary.run()"],
-                     model_energyEBreducedRechit_run : ["EcalRecHitsSorted_reducedEcalRecHitsEB__RECO.obj.obj.energy():EventAuxiliary.run()", "logz"],
-                     model_energyEEreducedRechit_run : ["EcalRecHitsSorted_reducedEcalRecHitsEE__RECO.obj.obj.energy():EventAuxiliary.run()", "logz"],
-                     model_numberEBrechit_run : ["EcalRecHitsSorted_ecalRecHit_EcalRecHitsEB_RECO.obj.size():EventAuxiliary.run()"],
-                     model_numberEErechit_run : ["EcalRecHitsSorted_ecalRecHit_EcalRecHitsEE_RECO.obj.size():EventAuxiliary.run()"],
-                     model_energyEBrechit_run : ["EcalRecHitsSorted_ecalRecHit_EcalRecHitsEB_RECO.obj.obj.energy():EventAuxiliary.run()", "logz"],
-                     model_energyEErechit_run : ["EcalRecHitsSorted_ecalRecHit_EcalRecHitsEE_RECO.obj.obj.energy():EventAuxiliary.run()", "logz"],
-                     # #model_numberEBdigi_run : ["EBDigiCollection_selectDigi_selectedEcalEBDigiCollection_RECO.obj.size():EventAuxiliary.run()", "logz"],
-                     # #model_numberEEdigi_run : ["EEDigiCollection_selectDigi_selectedEcalEEDigiCollection_RECO.obj.size():EventAuxiliary.run()", "logz"],
-                     model_numberBasicClusterEB_run : ["recoCaloClusters_particleFlowSuperClusterECAL_particleFlowBasicClusterECALBarrel_RECO.obj.size():EventAuxiliary.run()", "logz"],
-                     model_etaBasicClusterEB_run : ["recoCaloClusters_particleFlowSuperClusterECAL_particleFlowBasicClusterECALBarrel_RECO.obj.eta():EventAuxiliary.run()"],
-                     model_energyBasicClusterEB_run : ["recoCaloClusters_particleFlowSuperClusterECAL_particleFlowBasicClusterECALBarrel_RECO.obj.energy():EventAuxiliary.run()", "logz"],
-                     model_numberBasicClusterEE_run : ["recoCaloClusters_particleFlowSuperClusterECAL_particleFlowBasicClusterECALEndcap_RECO.obj.size():EventAuxiliary.run()", "logz"],
-                     model_etaBasicClusterEE_run : ["recoCaloClusters_particleFlowSuperClusterECAL_particleFlowBasicClusterECALEndcap_RECO.obj.eta():EventAuxiliary.run()"],
-                     model_energyBasicClusterEE_run : ["recoCaloClusters_particleFlowSuperClusterECAL_particleFlowBasicClusterECALEndcap_RECO.obj.energy():EventAuxiliary.run()", "logz"],
-    }
+    # model histograms and expressions are defined in the spec file, see procUtils/histSpec.py for the format
+    registry = loadHistogramSpecs(args.specFile)
+    histsAndExprs,specHashes = compileHistogramSpecs(registry, runAxis, args.storage)
+
+    # the time-independent sample, if any, is processed together with the main one, with a single run bin
+    # (its histograms are not taken from the cache, they are always filled again)
+    timeIndepSample = None
+    if args.timeIndependentInput:
+        timeIndepFiles = getInputFiles(args.timeIndependentInput, args.nMaxFiles)
+        timeIndepRunAxis = [1, 0.0, 10.0]
+        if args.exactRunAxis:
+            timeIndepRunAxis = getExactRunAxis(timeIndepFiles, metadataCache, treename) or timeIndepRunAxis
+        timeIndepScale = 1.0
+        if sampling:
+            timeIndepFiles,timeIndepSelections,timeIndepScale = sampleClusters(timeIndepFiles, args.sampleFraction, metadataCache, treename)
+            entrySelections.update(timeIndepSelections)
+        timeIndepHists,_ = compileHistogramSpecs(registry, timeIndepRunAxis, args.storage)
+        timeIndepSample = {"files" : timeIndepFiles, "registry" : registry, "runAxis" : timeIndepRunAxis}
+        print(f"Time-independent sample: there are {len(timeIndepFiles)} files to process")
+
+    if args.memoryReport:
+        printMemoryReport(list(histsAndExprs) + (list(timeIndepHists) if timeIndepSample != None else []),
+                          args.nThreads if args.nThreads > 0 else ROOT.ROOT.GetThreadPoolSize())
 
     
-    canvas   = ROOT.TCanvas("canvas","", 800,800)
-    canvas1D = ROOT.TCanvas("canvas1D","", 900,800)
-    canvas1Dshort = ROOT.TCanvas("canvas1Dshort","", 800,700)
+    getCanvases()
     adjustSettings_CMS_lumi()
 
-    runBins = []
-    nIOV = 1
-
+    # histograms already in the output file are reused if neither their spec nor the input files changed
     foutname = outdir + "allHistograms.root"
-    fout = ROOT.TFile.Open(foutname, "RECREATE")
-    fout.cd()
-    
+    selection = {}
+    if runRanges:
+        selection["runs"] = runRanges
+    if sampling:
+        selection["sampleFraction"] = args.sampleFraction
+    inputFingerprint = getInputFingerprint(files, selection=json.dumps(selection, sort_keys=True) if selection else "")
+    cached = {} if args.noCache else loadCachedHistograms(foutname, specHashes, inputFingerprint)
+    toProcess = {}
     for h,extra in histsAndExprs.items():
-
-        expr = extra[0]
-        opts = extra[1:] if len(extra) > 1 else []
-        logging.info(f"Processing {h.GetName()}")
-        chain.Draw(f"{expr}>>{h.GetName()}", "1", "goff")
-        h.SetDirectory(0)
-
-        if h.Integral() == 0.0:
-            logging.warning(f"{h.GetName()} has no entries, please check! It will be skipped")
-            if h.GetDimension() == 1 and h.Integral(0, 1+h.GetNbinsX()) > 0.0:
-                logging.warning(f"There seems to be events in the under/overflow bins, though, so check the range")
-            continue
-        
-        if h.GetName() == "runNumber":
-            for i in range(1, 1+h.GetNbinsX()):
-                if h.GetBinContent(i) > 0:
-                    runBins.append(i)
-            nIOV = len(runBins)
-                    
-        if h.GetDimension() == 1:
-
-            drawTH1(h, h.GetTitle(),
-                    "Events", outdir, h.GetName(),
-                    passCanvas=canvas1Dshort,
-                    skipStatBox=True if "skipStatBox" in opts else False,
-                    setLogy=True if "logy" in opts else False
-            )
-            h.Write()
-            
-        elif h.GetDimension() == 2:
-
-            drawCorrelationPlot(h,
-                                h.GetXaxis().GetTitle(), h.GetYaxis().GetTitle(), h.GetZaxis().GetTitle(),
-                                h.GetName(), outdir=outdir, drawProfileX=True,
-                                draw_both0_noLog1_onlyLog2=2 if "logz" in opts else 1,
-                                passCanvas=canvas, palette=57, skipLumi=True)            
-            hists = [h.ProjectionY(f"{h.GetName()}_projY_IOV{i+1}",runBins[i],runBins[i],"e") for i in range(nIOV)]
-            legEntries = [f"IOV {i+1}" for i in range(nIOV)]
-            if len(hists) == 1:
-                drawTH1(hists[0], h.GetYaxis().GetTitle(),
-                        "Events", outdir, hists[0].GetName(),
-                        passCanvas=canvas1Dshort,
-                        skipStatBox=True if "skipStatBox" in opts else False,
-                        setLogy=True if "logy" in opts else False
-                )
+        if h.GetName() in cached:
+            h.Add(cached[h.GetName()])
+        else:
+            toProcess[h] = extra
+
+    # book all histograms on the same dataframe, and fill them with a single loop on the events
+    # only reading the branches used by their expressions
+    if toProcess or timeIndepSample != None:
+        allFiles = files + (timeIndepSample["files"] if timeIndepSample != None else [])
+        # entries actually processed (after the selections of runs or sampling), as counted by the event loops
+        nEntries = 0
+        # partial histograms are saved periodically, so that a job that died can be resumed with --resume
+        checkpoint = None
+        if args.checkpointEvery > 0 or args.resume:
+            checkpoint = checkpointFile(outdir + "checkpoint.root", {h.GetName() : specHashes[h.GetName()] for h in toProcess},
+                                        inputFingerprint, every=args.checkpointEvery if args.checkpointEvery > 0 else 10)
+        # partial results published while running, for a quick look
+        snapshot = None
+        if args.liveEvents > 0 or args.liveSeconds > 0:
+            liveOutdir = outdir + "live/"
+            createPlotDirAndCopyPhp(liveOutdir)
+            livePlots = [x for x in args.livePlots.split(",") if x]
+            snapshot = liveSnapshot(liveOutdir + "liveHistograms.root", everyEvents=args.liveEvents, everySeconds=args.liveSeconds,
+                                    render=lambda hists: plotLiveSnapshot(hists, livePlots, liveOutdir))
+            if args.liveEvents <= 0 and args.rangesPerFile <= 0:
+                logging.warning("Live snapshots are only taken after each file is processed: use --live-events or --ranges-per-file to have them more often")
+        if timeIndepSample != None and (checkpoint != None or snapshot != None):
+            logging.warning("Checkpoints and live snapshots are not supported with --time-indep-input, they are disabled")
+            checkpoint = None
+            snapshot = None
+        if args.engine == "columnar":
+            if runRanges != None or sampling:
+                logging.error("Selection of runs and sampling are not supported by the columnar engine. Exit")
+                quit()
+            if snapshot != None:
+                logging.warning("Live snapshots are not supported by the columnar engine")
+            if checkpoint != None:
+                logging.warning("Checkpoints are not supported by the columnar engine, all files will be processed")
+                checkpoint = None
+            filled,nEntries = fillHistogramsColumnar(files, {h.GetName() : registry[h.GetName()] for h in toProcess},
+                                                     runAxis, treename=treename, stepSize=args.stepSize, storage=args.storage)
+            for h in toProcess:
+                h.Add(filled[h.GetName()])
+            if timeIndepSample != None:
+                filled,n = fillHistogramsColumnar(timeIndepSample["files"], registry, timeIndepSample["runAxis"],
+                                                  treename=treename, stepSize=args.stepSize, storage=args.storage)
+                nEntries += n
+                for h in timeIndepHists:
+                    h.Add(filled[h.GetName()])
+        else:
+            neededBranches = getBranchesFromExpressions([extra[0] for extra in toProcess.values()], chain)
+            pruneBranches(chain, neededBranches)
+            configureTreeCache(chain, neededBranches, readSettings)
+            reportBranchPruning(chain, neededBranches)
+            print("\n\n")
+            staging = None
+            if args.stageDir:
+                transport = localTransport(args.stageFrom) if args.stageFrom else xrootdTransport()
+                staging = stagingCache(args.stageDir, args.stageSize * 1e9, transport=transport, nTransfers=args.stageTransfers)
+            resumed,completed = checkpoint.load() if checkpoint != None and args.resume else ({},[])
+            if args.nJobs > 1 or staging != None or args.readSummary or checkpoint != None or snapshot != None or timeIndepSample != None or runRanges != None or sampling:
+                completed = set(completed)
+                # entry ranges are processed single-threaded (the entry number is needed), so with a selection of runs or sampling,
+                # or files split for the live snapshots, the threads are used as processes of a pool, each processing some of the ranges
+                nJobs = args.nJobs
+                splitFiles = runRanges != None or sampling or (snapshot != None and (args.liveEvents > 0 or args.rangesPerFile > 0))
+                if nJobs <= 1 and splitFiles and ROOT.ROOT.IsImplicitMTEnabled():
+                    nJobs = ROOT.ROOT.GetThreadPoolSize()
+                    ROOT.ROOT.DisableImplicitMT()
+                    logging.info(f"Processing the entry ranges with {nJobs} parallel jobs")
+                filled,nEntries = fillHistogramsInPool([f for f in files if f not in completed] if toProcess else [], {h.GetName() : registry[h.GetName()] for h in toProcess},
+                                              runAxis, treename=treename,
+                                              nJobs=nJobs, nThreads=args.nThreads if nJobs == args.nJobs else 1, staging=staging,
+                                              readSettings=readSettings, rangesPerFile=args.rangesPerFile,
+                                              metadataCache=metadataCache, checkpoint=checkpoint, initial=resumed,
+                                              snapshot=snapshot, samples={"timeIndep" : timeIndepSample} if timeIndepSample != None else None,
+                                              entryRanges=entryRanges, runSelection=runRanges, entrySelections=entrySelections,
+                                              storage=args.storage, macros=rdfMacros)
+                # only scaled with sampling, since Scale adds the sum of squared weights (see the storage policies in histSpec.py)
+                for h in toProcess:
+                    h.Add(filled[h.GetName()])
+                    if sampling:
+                        h.Scale(sampleScale)
+                if timeIndepSample != None:
+                    for h in timeIndepHists:
+                        h.Add(filled[f"timeIndep/{h.GetName()}"])
+                        if sampling:
+                            h.Scale(timeIndepScale)
             else:
-                drawNTH1(hists, legEntries, h.GetYaxis().GetTitle(), h.GetZaxis().GetTitle(),
-                         f"{h.GetName()}_projY", outdir=outdir, draw_both0_noLog1_onlyLog2=2 if "logz" in opts else 1,
-                         labelRatioTmp="IOV_{N} / IOV_{1}::0.5,1.5",
-                         legendCoords="0.75,0.95,0.4,0.9", lowerPanelHeight=0.3, passCanvas=canvas1D,
-                         skipLumi=True, drawLineMarkerAsPalette=True, palette=105)
-
-            h.Write()
-            for hist in hists:
-                hist.Write()
-            
-        elif h.GetDimension() == 3:
-
-            ####
-            #### Doesn't work as expected when filling histograms
-            
-            # Y vs X (number vs run)
-            projYvsX = getTH2fromTH3(h, f"{h.GetName()}_number_run", binStart=1, binEnd=h.GetNbinsZ(), proj="yxe")
-            drawCorrelationPlot(projYvsX,
-                                projYvsX.GetXaxis().GetTitle(), projYvsX.GetYaxis().GetTitle(), "Events",
-                                projYvsX.GetName(), outdir=outdir, drawProfileX=True,
-                                draw_both0_noLog1_onlyLog2=2 if "logy" in opts else 1,
-                                passCanvas=canvas, palette=57, skipLumi=True)            
-            hists = [projYvsX.ProjectionY(f"{projYvsX.GetName()}_projY_IOV{i+1}",runBins[i],runBins[i],"e") for i in range(nIOV)]
-            legEntries = [f"IOV {i+1}" for i in range(nIOV)]
-            drawNTH1(hists, legEntries, projYvsX.GetYaxis().GetTitle(), "Events",
-                     f"{projYvsX.GetName()}_projY", outdir=outdir, draw_both0_noLog1_onlyLog2=2 if "logy" in opts else 1,
-                     legendCoords="0.75,0.95,0.4,0.9", lowerPanelHeight=0.0, passCanvas=canvas1D,
-                     skipLumi=True, drawLineMarkerAsPalette=True, palette=105)
-
-            h.Write()
-            projYvsX.Write()
-            for hist in hists:
-                hist.Write()
-            
-            # Z vs X (energy vs run)
-            projZvsX = getTH2fromTH3(h, f"{h.GetName()}_energy_run", binStart=-1, proj="zxe")
-            drawCorrelationPlot(projZvsX,
-                                projZvsX.GetXaxis().GetTitle(), projZvsX.GetZaxis().GetTitle(), "Events",
-                                projZvsX.GetName(), outdir=outdir, drawProfileX=True,
-                                draw_both0_noLog1_onlyLog2=2 if "logz" in opts else 1,
-                                passCanvas=canvas, palette=57, skipLumi=True)            
-            hists = [projZvsX.ProjectionY(f"{projZvsX.GetName()}_projY_IOV{i+1}",runBins[i],runBins[i],"e") for i in range(nIOV)]
-            legEntries = [f"IOV {i+1}" for i in range(nIOV)]
-            drawNTH1(hists, legEntries, projZvsX.GetZaxis().GetTitle(), "Events",
-                     f"{projZvsX.GetName()}_projY", outdir=outdir, draw_both0_noLog1_onlyLog2=2 if "logz" in opts else 1,
-                     legendCoords="0.75,0.95,0.4,0.9", lowerPanelHeight=0.0, passCanvas=canvas1D,
-                     skipLumi=True, drawLineMarkerAsPalette=True, palette=105)
-
-            projZvsX.Write()
-            for hist in hists:
-                hist.Write()
+                countersBefore = getReadCounters()
+                rdf = ROOT.RDataFrame(chain)
+                booked = bookHistograms(rdf, toProcess, chain)
+                entries = rdf.Count()
+                runEventLoop(booked)
+                nEntries = entries.GetValue()
+                printReadSummary({"all files" : getReadCountersDifference(getReadCounters(), countersBefore)})
+        metadataCache.save()
+        print(f"Processed {nEntries} entries from {len(allFiles)} files")
 
+    fout = ROOT.TFile.Open(foutname, "RECREATE")
+    fout.cd()
+    renderJobs = writeHistograms(histsAndExprs, registry, outdir)
+    if timeIndepSample != None:
+        timeIndepOutdir = outdir + "timeIndep/"
+        createPlotDirAndCopyPhp(timeIndepOutdir)
+        fout.mkdir("timeIndep").cd()
+        renderJobs += writeHistograms(timeIndepHists, registry, timeIndepOutdir, directory="timeIndep/")
+        fout.cd()
+
+    writeCacheInfo(fout, {name : specHash for name,specHash in specHashes.items() if fout.GetKey(name)}, inputFingerprint)
     fout.Close()
+    if toProcess and checkpoint != None:
+        checkpoint.remove()
     print(f"All histograms saved in file {foutname}")
     print()
+
+    # plots are made from the histograms saved in the output file, possibly in parallel
+    renderPlots(foutname, renderJobs, nJobs=args.nPlotJobs if args.nPlotJobs > 0 else args.nJobs, rootlogon=rootlogon, skipUnchanged=not args.forcePlots, formats=plotFormats)
+    if deferredFormats:
+        queueDeferredExport(exportQueue, foutname, renderJobs, deferredFormats)